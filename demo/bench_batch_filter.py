@@ -0,0 +1,50 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import time
+import numpy as np
+from image_analysis.pipeline import OrientationFilter
+from image_analysis.pipeline import BatchOrientationFilter
+
+
+def throughput(extract, batches):
+    # first call builds the plans
+    extract(batches[0])
+    start = time.time()
+    for batch in batches:
+        extract(batch)
+    nframes = len(batches) * len(batches[0])
+    return nframes / (time.time() - start)
+
+
+print('{:>10} {:>6} {:>14} {:>14}'.format('frame', 'batch', 'frame op fps',
+                                          'batch op fps'))
+for shape in [(480, 640), (1080, 1920)]:
+    for batch_size in [8, 32]:
+        # uint8 frames, like decoded video
+        batches = [np.random.randint(0, 256, (batch_size, shape[0],
+                                              shape[1], 3), dtype=np.uint8)
+                   for _ in range(3)]
+        args = ('bowtie', 90, 20, max(shape), .2, max(shape), 'triangle')
+        frame_filter = OrientationFilter(*args)
+        batch_filter = BatchOrientationFilter(*args)
+
+        per_frame = throughput(
+            lambda batch: [frame_filter.extract(frame) for frame in batch],
+            batches)
+        batched = throughput(batch_filter.extract, batches)
+        print('{:>10} {:>6} {:>14.1f} {:>14.1f}'.format(
+            '{}x{}'.format(*shape), batch_size, per_frame, batched))
@@ -0,0 +1,57 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import os
+import time
+import numpy as np
+from image_analysis.decode import frames_to_patches
+from image_analysis.decode import iter_patches
+
+
+def naive_patches(frames, patch_dims):
+    # the old loop over every offset, one window of o frames at a time
+    n, m, o = patch_dims
+    T, N, M = frames.shape
+    patches = []
+    for t in range(T - o + 1):
+        for i in range(N - n + 1):
+            for j in range(M - m + 1):
+                patches.append(frames[t:t + o, i:i + n, j:j + m].flatten())
+    return np.array(patches)
+
+
+def throughput(extract):
+    start = time.time()
+    n_patches = extract()
+    return n_patches / (time.time() - start)
+
+
+vid_path = os.path.join(os.path.dirname(__file__), 'test_video.mp4')
+patch_dims = (3, 3, 2)
+
+print('{:>10} {:>16} {:>16}'.format('frames', 'naive patch/s',
+                                    'strided patch/s'))
+for n_frames in [2, 4]:
+    frames = np.random.randint(0, 256, (n_frames, 240, 320), dtype=np.uint8)
+    naive = throughput(lambda: len(naive_patches(frames, patch_dims)))
+    strided = throughput(lambda: len(frames_to_patches(frames, patch_dims)))
+    print('{:>10} {:>16.0f} {:>16.0f}'.format(n_frames, naive, strided))
+
+# including the decode, reading the video
+video = throughput(lambda: sum(len(batch) for batch in iter_patches(
+    vid_path, patch_dims, n_frames=60)))
+print('iter_patches on 60 frames of {}: {:.0f} patch/s'.format(
+    os.path.basename(vid_path), video))
@@ -1,3 +1,11 @@
 from .video_decoder import decode_mpeg
+from .video_decoder import iter_mpeg_batches
+from .metadata import MetadataCache
+from .metadata import VideoMetadata
+from .metadata import get_metadata
+from .metadata import metadata_cache
+from .patch_store import PatchStore
 
-# import extract patches once ready
\ No newline at end of file
+from .extract_patches import extract_patches
+from .extract_patches import iter_patches
+from .extract_patches import frames_to_patches
\ No newline at end of file
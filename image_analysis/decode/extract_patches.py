@@ -13,9 +13,14 @@
 # limitations under the License.
 # ==============================================================================
 
-import numpy as np
-import skvideo.io
+import math
+import numbers
 import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from .metadata import get_metadata
+from .patch_store import PatchStore
+from .video_decoder import iter_mpeg_batches
 
 
 def get_mpeg_dims(vid_fname):
@@ -26,72 +31,208 @@ def get_mpeg_dims(vid_fname):
     RETURNS:
         :(tuple): containing number of rows, columns, and frames of data
     """
-    meta_data = skvideo.io.ffprobe(vid_fname)
-    height = meta_data['video']['@height']
-    width = meta_data['video']['@width']
-    n_frames = meta_data['video']['@nb_frames']
+    metadata = get_metadata(vid_fname)
+    return (metadata.height, metadata.width, metadata.n_frames)
 
-    return (int(height), int(width), int(n_frames))
 
-
-def extract_patches(mpeg_path, patch_dims, save_dir, *, n_frames=None,
-                    batch_size=250000):
+def frames_to_patches(frames, patch_dims, idx=None):
     """
     DESCRIPTION:
-        extract patches (neighborhoods) of pixels from videos in batches and
-        save them to disk
+        every (n x m x o) patch of a stack of gray frames as one row, built
+        from a strided view of the frames instead of a loop over offsets
 
     ARGS:
-        :save_dir: directory to save extracted patches
-        :mpeg_path: file name for an mpeg video with one color channel
-        :patch_dims: size of patches to extract
-        :n_frames: number of frames to extract
-        :batch_size: size limit for each batch
+        :frames: (T x N x M) array of gray frames, T >= o
+        :patch_dims: (n, m, o) rows, columns and frames of a patch
+        :idx: array of patch numbers to extract, all patches if None
+
+    RETURNS:
+        (num_patches x n*m*o) array with num_patches =
+        (T - o + 1) * (N - n + 1) * (M - m + 1) (or len(idx)). Patches are
+        numbered by first frame, then row, then column, and each row is the
+        patch flattened in (frame, row, column) order.
     """
-    N, M, O = get_mpeg_dims(mpeg_path)
     n, m, o = patch_dims
-    ppr = (M - m + 1)
-    ppc = (N - n + 1)
-    ppf = (ppr)(N - n + 1)
+    # (T-o+1, N-n+1, M-m+1, o, n, m) view, the reshape is the only copy
+    windows = sliding_window_view(frames, (o, n, m))
+    if idx is None:
+        return windows.reshape(-1, n * m * o)
+    # only the selected patches are copied
+    return windows[np.unravel_index(idx, windows.shape[:3])].reshape(
+        -1, n * m * o)
+
 
-    vid_gen = skvideo.io.vreader(mpeg_path)
+def iter_patches(mpeg_path, patch_dims, *, n_frames=None, batch_size=250000,
+                 n_samples=None, fraction=None, seed=None):
+    """
+    DESCRIPTION:
+        extract patches (neighborhoods) of pixels from a video in batches.
+        Frames are decoded to gray by ffmpeg, and chunks of frames overlap
+        by o - 1 frames, so the rolling window of o frames never has to be
+        rebuilt in python.
+
+        With n_samples or fraction only a random sample of the patches is
+        extracted, and only the sampled patches are ever copied out of the
+        frames. n_samples draws a fixed number of patches uniformly with
+        reservoir sampling, so memory stays at n_samples patches however
+        long the video is, but nothing is yielded before the last frame.
+        fraction keeps each patch with that probability and yields the
+        sample as the video is decoded.
+
+    ARGS:
+        :mpeg_path: file name for an mpeg video
+        :patch_dims: (n, m, o) rows, columns and frames of a patch
+        :n_frames: number of frames to use, all frames if None
+        :batch_size: size limit (patches) for each batch
+        :n_samples: number of patches to sample
+        :fraction: probability of keeping each patch (0 < fraction <= 1)
+        :seed: seed (or np.random.Generator) for the sampling
 
+    RETURNS:
+        generator of (<= batch_size x n*m*o) uint8 arrays, in the order of
+        frames_to_patches
+    """
+    N, M, O = get_mpeg_dims(mpeg_path)
+    n, m, o = patch_dims
     if n_frames is None:
-        end = O - o + 1
-    elif n_frames > (O - o + 1) and n_frames < o:
-        raise ValueError('End frame index is out of range.')
-    else:
-        end = n_frames
-
-    count = 0
-    frames = []
-    batches = []
-    for frame in vid_gen:
-        if count < end and count < o:
-            frames.append(frame)
-        elif count < end:
-            arr = np.array(frames)
-            for i in range(ppr):
-                for j in range(ppc):
-                    batches.append(arr[:, i: i + n, j: j + m].flatten())
-            del frames[0]
-            frames.append(frame)
-            batches = np.array(batches)
-            np.save(batches, save_dir + 'batch_' + str(count))
-            batches = []
+        n_frames = O
+    if not o <= n_frames <= O:
+        raise ValueError('n_frames must be between {0} and {1}'.format(o, O))
+    if not (1 <= n <= N and 1 <= m <= M and o >= 1):
+        raise ValueError('Patch dims {0} do not fit {1}x{2} frames'
+                         .format(patch_dims, N, M))
+    if batch_size < 1:
+        raise ValueError('Cannot use batch_size < 1')
+    if n_samples is not None and fraction is not None:
+        raise ValueError('Cannot use both n_samples and fraction')
+    if n_samples is not None and n_samples < 1:
+        raise ValueError('Cannot use n_samples < 1')
+    if fraction is not None and not 0 < fraction <= 1:
+        raise ValueError('fraction must be in (0, 1]')
+
+    # decode about batch_size patches worth of temporal windows at once
+    ppf = (N - n + 1) * (M - m + 1)
+    chunk = max(1, batch_size // ppf)
+    chunks = iter_mpeg_batches(mpeg_path, batch_size=chunk + o - 1,
+                               stride=chunk, end_idx=n_frames - 1,
+                               pad=False, gray=True)
+    rng = np.random.default_rng(seed)
+
+    if n_samples is not None:
+        patches = reservoir_sample(chunks, patch_dims, n_samples, rng)
+        for first in range(0, len(patches), batch_size):
+            yield patches[first:first + batch_size]
+        return
+
+    for frames in chunks:
+        if fraction is not None:
+            count = (len(frames) - o + 1) * ppf
+            idx = np.flatnonzero(rng.random(count) < fraction)
+            patches = frames_to_patches(frames, patch_dims, idx)
         else:
-            break
-        count += 1
+            patches = frames_to_patches(frames, patch_dims)
+        for first in range(0, len(patches), batch_size):
+            yield patches[first:first + batch_size]
 
-# def main():
-#     vid_path = os.getcwd() + '/../data/input/test_video.mp4'
-#     # '/../data/input/subj5-4hr.avi'
-#     patch_dims = (3, 3, 2)
-#     n_frames = 100    # 104322
-#     save_dir = os.getcwd() + '/../data/working/motion_patches/'
-#     patches = extract_patches(vid_path, patch_dims,
-#                               save_dir, n_frames=n_frames)
 
+def reservoir_sample(chunks, patch_dims, n_samples, rng=None):
+    """
+    DESCRIPTION:
+        uniform sample of n_samples patches without replacement from chunks
+        of frames, using reservoir sampling with geometric skips (Li's
+        algorithm L). The random numbers drawn scale with the number of
+        patches that enter the reservoir, not with the number of patches.
+
+    ARGS:
+        :chunks: iterable of (T x N x M) frame stacks, consecutive stacks
+                 overlapping by o - 1 frames
+        :patch_dims: (n, m, o) rows, columns and frames of a patch
+        :n_samples: number of patches to sample
+        :rng: np.random.Generator
+
+    RETURNS:
+        (<= n_samples x n*m*o) array, the sampled patches in the order of
+        the video (fewer than n_samples if there are not enough patches)
+    """
+    n, m, o = patch_dims
+    rng = np.random.default_rng(rng)
+    reservoir = None
+    positions = np.empty(n_samples, dtype=np.int64)
+    seen = 0
+    # log(1 - random()) keeps log away from 0
+    w = math.exp(math.log(1 - rng.random()) / n_samples)
+    next_idx = n_samples + int(math.log(1 - rng.random()) /
+                               math.log(1 - w))
+
+    for frames in chunks:
+        count = (len(frames) - o + 1) * (frames.shape[1] - n + 1) * \
+            (frames.shape[2] - m + 1)
+        # reservoir slot of each patch of this chunk that gets kept
+        slots = {}
+        for i in range(seen, min(seen + count, n_samples)):
+            slots[i] = i
+        while next_idx < seen + count:
+            slots[next_idx] = int(rng.integers(n_samples))
+            w *= math.exp(math.log(1 - rng.random()) / n_samples)
+            next_idx += 1 + int(math.log(1 - rng.random()) / math.log(1 - w))
+
+        if slots:
+            # a later patch replaces an earlier one in the same slot
+            kept = {slot: idx for idx, slot in slots.items()}
+            idx = np.fromiter(kept.values(), dtype=np.int64)
+            slot = np.fromiter(kept.keys(), dtype=np.int64)
+            if reservoir is None:
+                reservoir = np.empty((n_samples, n * m * o),
+                                     dtype=frames.dtype)
+            reservoir[slot] = frames_to_patches(frames, patch_dims,
+                                                idx - seen)
+            positions[slot] = idx
+        seen += count
+
+    n_kept = min(seen, n_samples)
+    if reservoir is None:
+        return np.empty((0, n * m * o), dtype=np.uint8)
+    return reservoir[np.argsort(positions[:n_kept], kind='stable')]
+
+
+def extract_patches(mpeg_path, patch_dims, save_path, *, n_frames=None,
+                    batch_size=250000, n_samples=None, fraction=None,
+                    seed=None):
+    """
+    DESCRIPTION:
+        extract patches (neighborhoods) of pixels from videos in batches and
+        save them to disk in one PatchStore, flushed every batch_size
+        patches. n_samples or fraction save a random sample of the patches,
+        see iter_patches.
+
+    ARGS:
+        :save_path: file for the PatchStore, replaced if it exists
+        :mpeg_path: file name for an mpeg video
+        :patch_dims: (n, m, o) rows, columns and frames of a patch
+        :n_frames: number of frames to use, all frames if None
+        :batch_size: size limit (patches) for each batch
+        :n_samples: number of patches to sample
+        :fraction: probability of keeping each patch (0 < fraction <= 1)
+        :seed: seed (or np.random.Generator) for the sampling, only an
+               integer seed is kept in the attrs
 
-# if __name__ == '__main__':
-#     main()
+    RETURNS:
+        read only PatchStore of the (num_patches x n*m*o) patches
+    """
+    n, m, o = patch_dims
+    # the index is JSON, so numpy scalars become python numbers and a
+    # Generator seed is not recorded
+    attrs = {'video': os.path.basename(mpeg_path),
+             'patch_dims': [int(dim) for dim in patch_dims],
+             'n_samples': int(n_samples) if n_samples is not None else None,
+             'fraction': float(fraction) if fraction is not None else None,
+             'seed': int(seed) if isinstance(seed, numbers.Integral)
+             else None}
+    with PatchStore(save_path, mode='w', n_features=n * m * o,
+                    dtype=np.uint8, batch_size=batch_size,
+                    attrs=attrs) as store:
+        for batch in iter_patches(mpeg_path, patch_dims, n_frames=n_frames,
+                                  batch_size=batch_size, n_samples=n_samples,
+                                  fraction=fraction, seed=seed):
+            store.append(batch)
+    return PatchStore(save_path, mode='r')
@@ -0,0 +1,178 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import collections
+import fractions
+import json
+import os
+import tempfile
+import threading
+import skvideo.io
+
+# n_frames is None if the container doesn't store a frame count
+VideoMetadata = collections.namedtuple(
+    'VideoMetadata', ['height', 'width', 'n_frames', 'fps', 'pix_fmt'])
+
+
+class MetadataCache:
+    """
+    DESCRIPTION:
+        Least recently used cache of video metadata, so each video is
+        probed with ffprobe (a subprocess) once instead of once per decode
+        call. Entries are keyed by the absolute path, size and mtime of the
+        video, so an edited video is probed again. With sidecar set the
+        metadata is also saved next to the video as <video>.meta.json and
+        reused by other processes.
+
+    ARGS:
+        :max_entries: number of videos to keep metadata for
+        :sidecar: read and write <video>.meta.json files
+    """
+    def __init__(self, max_entries=128, sidecar=False):
+        self.max_entries = max_entries
+        self.sidecar = sidecar
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_entries=None, sidecar=None):
+        """
+        DESCRIPTION:
+            change the number of entries and/or the sidecar setting
+
+        ARGS:
+            :max_entries: number of videos to keep metadata for
+            :sidecar: read and write <video>.meta.json files
+        """
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+                self._evict()
+            if sidecar is not None:
+                self.sidecar = sidecar
+
+    def get(self, v_path):
+        """
+        DESCRIPTION:
+            metadata of a video, probed only if it is not cached
+
+        ARGS:
+            :v_path: Path to the video
+
+        RETURNS:
+            VideoMetadata(height, width, n_frames, fps, pix_fmt), fps is a
+            fractions.Fraction
+        """
+        v_path = os.path.abspath(v_path)
+        stat = os.stat(v_path)
+        key = (v_path, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        metadata = None
+        if self.sidecar:
+            metadata = self._load_sidecar(key)
+        if metadata is None:
+            metadata = probe(v_path)
+            if self.sidecar:
+                self._save_sidecar(key, metadata)
+
+        with self._lock:
+            self._entries[key] = metadata
+            self._evict()
+        return metadata
+
+    def clear(self):
+        """
+        DESCRIPTION:
+            drop all in memory entries, sidecar files are kept
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load_sidecar(self, key):
+        v_path, size, mtime_ns = key
+        try:
+            with open(v_path + '.meta.json') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('size') != size or saved.get('mtime_ns') != mtime_ns:
+            return None
+        return VideoMetadata(saved['height'], saved['width'],
+                             saved['n_frames'],
+                             fractions.Fraction(saved['fps']),
+                             saved['pix_fmt'])
+
+    def _save_sidecar(self, key, metadata):
+        v_path, size, mtime_ns = key
+        saved = dict(metadata._asdict(), fps=str(metadata.fps), size=size,
+                     mtime_ns=mtime_ns)
+        # the video directory may be read only, the sidecar is optional
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(v_path))
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, v_path + '.meta.json')
+        except BaseException as err:
+            os.remove(tmp_path)
+            if not isinstance(err, OSError):
+                raise
+
+
+def probe(v_path):
+    """
+    DESCRIPTION:
+        runs ffprobe on a video, use get_metadata to probe it only once
+
+    ARGS:
+        :v_path: Path to the video
+
+    RETURNS:
+        VideoMetadata of the first video stream
+    """
+    video = skvideo.io.ffprobe(v_path)['video']
+    n_frames = video.get('@nb_frames')
+    return VideoMetadata(int(video['@height']), int(video['@width']),
+                         int(n_frames) if n_frames is not None else None,
+                         fractions.Fraction(video['@avg_frame_rate']),
+                         video['@pix_fmt'])
+
+
+def get_metadata(v_path):
+    """
+    DESCRIPTION:
+        metadata of a video from the process wide metadata_cache
+
+    ARGS:
+        :v_path: Path to the video
+
+    RETURNS:
+        VideoMetadata(height, width, n_frames, fps, pix_fmt)
+    """
+    return metadata_cache.get(v_path)
+
+
+# process wide cache used by the decode functions
+metadata_cache = MetadataCache()
@@ -0,0 +1,210 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import json
+import os
+import tempfile
+import numpy as np
+
+
+class PatchStore:
+    """
+    DESCRIPTION:
+        Appendable on-disk matrix of patches, one patch per row. Rows live
+        in a single raw file (path) and a small JSON index (path + '.json')
+        records dtype, row length, number of rows and user attrs. Appended
+        rows are buffered and written to the end of the file every
+        batch_size rows, so the file system is touched once per batch
+        instead of once per frame. Reads are slices of a read only
+        np.memmap, e.g. store[10**6:2 * 10**6] reads one contiguous block.
+
+        The index is only rewritten after the rows are on disk, so rows of
+        an interrupted flush are dropped when the store is reopened.
+
+    ARGS:
+        :path: file for the rows, the index is path + '.json'
+        :mode: 'r' read only, 'a' append (creates the store if needed) or
+               'w' create, replacing an existing store
+        :n_features: row length, taken from the first append if None
+        :dtype: dtype of the rows, taken from the first append if None
+        :batch_size: number of buffered rows that triggers a flush
+        :attrs: dict of JSON serializable values kept in the index
+    """
+    def __init__(self, path, mode='a', n_features=None, dtype=None,
+                 batch_size=250000, attrs=None):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError('mode must be r, a or w')
+        if batch_size < 1:
+            raise ValueError('Cannot use batch_size < 1')
+
+        self.path = path
+        self.index_path = path + '.json'
+        self.mode = mode
+        self.batch_size = batch_size
+        self.n_flushed = 0
+        self.attrs = {}
+        self._buffer = None
+        self._n_buffered = 0
+        self._memmap = None
+
+        if mode == 'w' or not os.path.exists(self.index_path):
+            if mode == 'r':
+                raise FileNotFoundError(self.index_path)
+            self.n_features = n_features
+            self.dtype = np.dtype(dtype) if dtype is not None else None
+            # an empty data file, the index is written on the first flush
+            open(path, 'wb').close()
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+        else:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.n_features = index['n_features']
+            self.dtype = np.dtype(index['dtype']) \
+                if index['dtype'] is not None else None
+            self.n_flushed = index['n_patches']
+            self.attrs = index['attrs']
+            if self.n_features is None:
+                self.n_features = n_features
+            if self.dtype is None and dtype is not None:
+                self.dtype = np.dtype(dtype)
+            if n_features is not None and n_features != self.n_features:
+                raise ValueError('Store has {0} features, not {1}'
+                                 .format(self.n_features, n_features))
+            if dtype is not None and np.dtype(dtype) != self.dtype:
+                raise ValueError('Store has dtype {0}, not {1}'
+                                 .format(self.dtype, np.dtype(dtype)))
+            if mode == 'a':
+                # drop the rows of a flush that never made it to the index
+                with open(path, 'r+b') as f:
+                    f.truncate(self.n_flushed * self._row_bytes()
+                               if self.n_flushed > 0 else 0)
+        if attrs is not None:
+            self.attrs.update(attrs)
+
+    def append(self, patches):
+        """
+        DESCRIPTION:
+            add rows, written to disk once batch_size rows are buffered
+
+        ARGS:
+            :patches: (num_patches x n_features) array, or one row
+        """
+        if self.mode == 'r':
+            raise ValueError('Store is read only')
+        patches = np.asarray(patches)
+        if patches.ndim == 1:
+            patches = patches[np.newaxis]
+        if self.n_features is None:
+            self.n_features = patches.shape[1]
+        if self.dtype is None:
+            self.dtype = patches.dtype
+        if patches.ndim != 2 or patches.shape[1] != self.n_features:
+            raise ValueError('Patches must have shape (n, {0}), not {1}'
+                             .format(self.n_features, patches.shape))
+        if self._buffer is None:
+            self._buffer = np.empty((self.batch_size, self.n_features),
+                                    dtype=self.dtype)
+
+        while len(patches) > 0:
+            if self._n_buffered == 0 and len(patches) >= self.batch_size:
+                # whole batches go straight to disk
+                n = len(patches) - len(patches) % self.batch_size
+                self._write(patches[:n])
+            else:
+                n = min(len(patches), self.batch_size - self._n_buffered)
+                self._buffer[self._n_buffered:self._n_buffered + n] = \
+                    patches[:n]
+                self._n_buffered += n
+                if self._n_buffered == self.batch_size:
+                    self.flush()
+            patches = patches[n:]
+
+    def flush(self):
+        """
+        DESCRIPTION:
+            write the buffered rows and the index to disk
+        """
+        if self.mode == 'r':
+            return
+        if self._n_buffered > 0:
+            self._write(self._buffer[:self._n_buffered])
+            self._n_buffered = 0
+        elif not os.path.exists(self.index_path):
+            self._write_index()
+
+    def as_array(self):
+        """
+        DESCRIPTION:
+            all rows as a read only memory map, buffered rows are flushed
+            first
+
+        RETURNS:
+            (num_patches x n_features) np.memmap (or empty array)
+        """
+        self.flush()
+        if self.n_flushed == 0:
+            return np.empty((0, self.n_features or 0),
+                            dtype=self.dtype if self.dtype is not None
+                            else np.uint8)
+        if self._memmap is None or len(self._memmap) != self.n_flushed:
+            self._memmap = np.memmap(self.path, dtype=self.dtype, mode='r',
+                                     shape=(self.n_flushed, self.n_features))
+        return self._memmap
+
+    def close(self):
+        """
+        DESCRIPTION:
+            flush and drop the memory map, views from store[...] stay valid
+        """
+        self.flush()
+        self._buffer = None
+        self._memmap = None
+
+    def __getitem__(self, idx):
+        return self.as_array()[idx]
+
+    def __len__(self):
+        return self.n_flushed + self._n_buffered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _row_bytes(self):
+        return self.n_features * self.dtype.itemsize
+
+    def _write(self, patches):
+        with open(self.path, 'ab') as f:
+            f.write(np.ascontiguousarray(patches, dtype=self.dtype).data)
+        self.n_flushed += len(patches)
+        self._write_index()
+
+    def _write_index(self):
+        index = {'n_patches': self.n_flushed, 'n_features': self.n_features,
+                 'dtype': self.dtype.str if self.dtype is not None else None,
+                 'attrs': self.attrs}
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
@@ -14,8 +14,17 @@
 # ==============================================================================
 
 
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import queue
+import tempfile
+import threading
 import skvideo.io
 import numpy as np
+from .metadata import get_metadata
 
 
 def pad_batch(batch, batch_size, frame, pad=True):
@@ -49,11 +58,112 @@ def pad_batch(batch, batch_size, frame, pad=True):
         raise ValueError('Something is wrong with the pad_batch function')
 
 
-def decode_mpeg(v_path, batch_size=1, stride=1, start_idx=0, end_idx=-1,
-                pad=True):
+def batch_windows(start_idx, end_idx, batch_size, stride):
+    """
+    DESCRIPTION:
+        Computes the frame ranges of the batches decoded from a video.
+        Batches begin at every stride'th frame from start_idx. Once a batch
+        reaches end_idx no further batches are started, since their frames
+        are already covered.
+
+    ARGS:
+        :start_idx: Index of first frame for first batch (integer >= 0)
+        :end_idx: Index of last frame in the range of interest (integer >= 0)
+        :batch_size: Number of frames in each batch
+        :stride: Stride indicates beginning of batches
+
+    RETURNS:
+        generator of (first, last) frame indices for each batch, last is
+        exclusive and never past end_idx + 1
+    """
+    first = start_idx
+    while first <= end_idx:
+        yield first, min(first + batch_size, end_idx + 1)
+        if first + batch_size - 1 >= end_idx:
+            break
+        first += stride
+
+
+def _prefetch(iterable, size, release=None, stop=None):
     """
     DESCRIPTION:
-        Creates a list of batches of frames from an MPEG file.
+        Runs an iterable in a background thread, keeping at most size items
+        decoded ahead of the consumer in a bounded queue.
+
+    ARGS:
+        :iterable: iterable to consume in the background
+        :size: maximum number of items to hold in the queue (integer >= 1)
+        :release: called with every item the consumer never received when
+                 it stops early, e.g. to give back ring slots
+        :stop: threading.Event the iterable watches to stop waiting, set
+              when the consumer stops
+
+    RETURNS:
+        generator over the items of iterable, in order
+    """
+    done = object()
+    items = queue.Queue(maxsize=size)
+    if stop is None:
+        stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer went away so the thread can exit
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        if release is not None and item[0] is not done:
+            release(item[0])
+        return False
+
+    def work():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as err:
+            put((done, err))
+            return
+        put((done, None))
+
+    worker = threading.Thread(target=work, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, err = items.get()
+            if item is done:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
+        if release is not None:
+            # the worker gives back the item it holds, then the queued
+            # ones are given back here
+            worker.join()
+            while True:
+                try:
+                    item, _ = items.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not done:
+                    release(item)
+
+
+def iter_mpeg_batches(v_path, batch_size=1, stride=1, start_idx=0,
+                      end_idx=-1, pad=True, prefetch=0, ring=None,
+                      cache_dir=None, seek=False, n_shards=1,
+                      shard_size=128, gray=False, size=None, scale=None,
+                      crop=None):
+    """
+    DESCRIPTION:
+        Lazily decodes batches of frames from an MPEG file. Each batch is
+        yielded as soon as its last frame is decoded, so at most one batch
+        worth of frames is held in memory. Same batch semantics as
+        decode_mpeg.
 
     ARGS:
         :v_path: Path to MPEG video (i.e. include the video's name &
@@ -65,12 +175,47 @@ def decode_mpeg(v_path, batch_size=1, stride=1, start_idx=0, end_idx=-1,
         :end_idx: Index of last frame in the range of interest (integer >= 0)
         :pad: Boolean value indicating whether the last batch should be
              padded if it is not full after decoding the mpeg
+        :prefetch: number of batches to decode ahead in a background thread
+                  so decoding overlaps with feature extraction. 0 decodes
+                  in the calling thread.
+        :ring: optional FrameRingBuffer with (batch_size, H, W, C) slots.
+              Each batch is written straight into a free slot (waiting
+              while all slots are in use) and the slot index is yielded
+              instead of the batch; the consumer reads ring[slot] and
+              releases it. Padding frames are zeros of the ring dtype.
+              Slots decoded ahead by prefetch are released when the
+              generator is closed.
+        :cache_dir: optional directory to cache the decoded frames in. The
+                   first call decodes frames start_idx..end_idx into a .npy
+                   file keyed by the video path, mtime, size and frame
+                   range; later calls memory map it and serve batches as
+                   read only slices of it instead of decoding again.
+        :seek: start decoding at start_idx with ffmpeg input seeking
+              instead of decoding and dropping every frame before it.
+              Frame indices are converted to timestamps with the average
+              frame rate, so this is only exact for constant frame rate
+              videos.
+        :n_shards: number of ffmpeg processes decoding consecutive shards
+                  of shard_size frames concurrently (each seeking to its
+                  first frame, so the same constant frame rate caveat
+                  applies). Frames are reassembled in order before
+                  batching. Up to (n_shards + 1) * shard_size frames are
+                  held in memory.
+        :shard_size: number of frames per shard, keep it well above the
+                    keyframe interval since each shard decodes from the
+                    keyframe before its first frame
+        :gray: decode straight to 8 bit grayscale (ffmpeg's luma, close
+              to but not bit identical with skimage's rgb2gray), frames
+              are (length x width)
+        :size: (height, width) to scale the frames to while decoding
+        :scale: factor to scale the frames by while decoding, instead of
+               size
+        :crop: (top, left, height, width) region to keep, applied before
+              scaling
 
     RETURNS:
-        LIST of NUMPY batches of frames (length x width x channels), and
-        if the last batch is not full, it is padded with frames of:
-        np.zeros((frame.shape))
-
+        generator of NUMPY batches of frames (length x width x channels),
+        or of ring slot indices
     """
 
     if start_idx < 0 or end_idx < -1:
@@ -81,49 +226,385 @@ def decode_mpeg(v_path, batch_size=1, stride=1, start_idx=0, end_idx=-1,
     if batch_size < 1 or stride < 1:
         raise ValueError('Cannot use batch_size or stride < 1')
 
-    batch_list = []
-    count = 0
-    temp = start_idx
-    batch = []
+    if prefetch < 0:
+        raise ValueError('Cannot use prefetch < 0')
+
+    if n_shards < 1 or shard_size < 1:
+        raise ValueError('Cannot use n_shards or shard_size < 1')
+
+    outputdict = output_params(v_path, gray=gray, size=size, scale=scale,
+                               crop=crop)
+
+    if ring is not None:
+        if not pad:
+            raise ValueError('Ring slots hold full batches, use pad=True')
+        if ring.slot_shape[0] != batch_size:
+            raise ValueError('Ring slots hold {0} frames, not batch_size {1}'
+                             .format(ring.slot_shape[0], batch_size))
 
     # grab frame count from video metadata
     if end_idx == -1:
-        metadata = skvideo.io.ffprobe(v_path)
-        vid_frame_count = int(metadata['video']['@nb_frames'])
-        end_idx = vid_frame_count - 1
-
-    # build batch_list
-    for frame in skvideo.io.vreader(v_path):
-        if count == end_idx:
-            if len(batch) == batch_size:
-                batch_list.append(np.array(batch))
-                batch = []
-            idx = count - ((count - start_idx) % stride)
-            if count >= idx and count < (idx + batch_size):
-                batch.append(frame)
-                batch_list.append(np.array(
-                    pad_batch(batch, batch_size, frame, pad=pad)))
-            if stride > batch_size:
-                return batch_list[1:]
-            elif batch_size >= stride:
-                return batch_list
-        elif count >= start_idx and stride > batch_size:
-            if (count - start_idx) % stride == 0:
-                temp = count
-                batch_list.append(np.array(batch))
-                batch = []
-                batch.append(frame)
-            elif temp < count and count < (temp + batch_size):
-                batch.append(frame)
-        elif count >= start_idx and batch_size >= stride:
-            if count - start_idx < batch_size:
-                batch.append(frame)
-            elif len(batch) == batch_size:
-                batch_list.append(np.array(batch))
-                batch = []
-                for x in range(stride - batch_size, 0):
-                    batch.append(batch_list[-1][x])
-                batch.append(frame)
-            elif len(batch) < batch_size:
-                batch.append(frame)
+        end_idx = get_metadata(v_path).n_frames - 1
+
+    # lets a prefetch thread waiting for a free slot give up once the
+    # consumer is gone
+    stop = threading.Event() if ring is not None and prefetch > 0 else None
+
+    if cache_dir is not None:
+        frames = cached_frames(v_path, start_idx, end_idx, cache_dir,
+                               seek=seek, n_shards=n_shards,
+                               shard_size=shard_size, outputdict=outputdict)
+        batches = _iter_cached_batches(frames, start_idx, batch_size, stride,
+                                       pad, ring, stop)
+    else:
+        frames = read_frames(v_path, start_idx, end_idx, seek=seek,
+                             n_shards=n_shards, shard_size=shard_size,
+                             outputdict=outputdict)
+        batches = _iter_batches(frames, batch_size, stride, start_idx,
+                                end_idx, pad, ring, stop)
+    if prefetch > 0:
+        batches = _prefetch(batches, prefetch,
+                            release=ring.release if ring is not None
+                            else None, stop=stop)
+
+    return batches
+
+
+def _iter_batches(decoded, batch_size, stride, start_idx, end_idx, pad,
+                  ring=None, stop=None):
+    """
+    DESCRIPTION:
+        Generator behind iter_mpeg_batches, arguments are already validated.
+        decoded iterates over the frames from start_idx on.
+    """
+    windows = batch_windows(start_idx, end_idx, batch_size, stride)
+    first, last = next(windows)
+
+    # the most recent frames, enough to rebuild any (overlapping) batch
+    frames = collections.deque(maxlen=batch_size)
+    count = start_idx
+    for frame in decoded:
+        frames.append(frame)
+        count += 1
+        while count == last:
+            batch = list(frames)[len(frames) - (last - first):]
+            if ring is not None:
+                yield _write_slot(ring, batch, stop)
+            else:
+                yield np.array(pad_batch(batch, batch_size, frame, pad=pad))
+            try:
+                first, last = next(windows)
+            except StopIteration:
+                return
+
+    # video is shorter than its metadata says, flush what we have
+    if first < count:
+        batch = list(frames)[len(frames) - (count - first):]
+        if ring is not None:
+            yield _write_slot(ring, batch, stop)
+        else:
+            yield np.array(pad_batch(batch, batch_size, batch[-1], pad=pad))
+
+
+def output_params(v_path, gray=False, size=None, scale=None, crop=None):
+    """
+    DESCRIPTION:
+        Builds the ffmpeg output parameters that crop, scale and/or convert
+        frames to grayscale while decoding, see iter_mpeg_batches.
+
+    ARGS:
+        :v_path: Path to MPEG video
+        :gray: decode to 8 bit grayscale
+        :size: (height, width) of the output frames
+        :scale: factor to scale the frames by, instead of size
+        :crop: (top, left, height, width) region to keep, before scaling
+
+    RETURNS:
+        outputdict for skvideo.io.vreader
+    """
+    if size is not None and scale is not None:
+        raise ValueError('Cannot use both size and scale')
+
+    outputdict = {}
+    if crop is not None or scale is not None:
+        metadata = get_metadata(v_path)
+        height, width = metadata.height, metadata.width
+
+    if crop is not None:
+        top, left, crop_height, crop_width = crop
+        if top < 0 or left < 0 or crop_height < 1 or crop_width < 1 or \
+                top + crop_height > height or left + crop_width > width:
+            raise ValueError('crop {0} is outside of the {1}x{2} frames'
+                             .format(crop, height, width))
+        height, width = crop_height, crop_width
+        outputdict['-vf'] = 'crop={0}:{1}:{2}:{3}'.format(width, height,
+                                                          left, top)
+    if scale is not None:
+        size = (max(1, int(round(height * scale))),
+                max(1, int(round(width * scale))))
+    if size is not None:
+        height, width = size
+    if crop is not None or size is not None:
+        # skvideo sizes its frames from -s, so it is set after a crop too
+        outputdict['-s'] = '{0}x{1}'.format(width, height)
+    if gray:
+        outputdict['-pix_fmt'] = 'gray'
+    return outputdict
+
+
+def read_frames(v_path, start_idx, end_idx, seek=False, n_shards=1,
+                shard_size=128, outputdict=None):
+    """
+    DESCRIPTION:
+        Decodes the frames start_idx..end_idx of a video.
+
+    ARGS:
+        :v_path: Path to MPEG video
+        :start_idx: Index of the first frame (integer >= 0)
+        :end_idx: Index of the last frame (integer >= start_idx)
+        :seek: seek to start_idx with ffmpeg instead of decoding the frames
+              before it, see iter_mpeg_batches
+        :n_shards: number of shards decoded concurrently, see
+                  iter_mpeg_batches
+        :shard_size: number of frames per shard
+        :outputdict: ffmpeg output parameters, see output_params
+
+    RETURNS:
+        generator of frames (length x width x channels), or (length x
+        width) for grayscale output
+    """
+    outputdict = outputdict or {}
+    if n_shards > 1:
+        frames = _read_shards(v_path, start_idx, end_idx,
+                              _frame_rate(v_path), n_shards, shard_size,
+                              outputdict)
+    elif seek and start_idx > 0:
+        frames = _read_range(v_path, start_idx, end_idx, _frame_rate(v_path),
+                             outputdict)
+    else:
+        frames = skvideo.io.vreader(v_path, num_frames=end_idx + 1,
+                                    outputdict=outputdict)
+        frames = itertools.islice(frames, start_idx, None)
+
+    if outputdict.get('-pix_fmt') == 'gray':
+        # drop the single channel axis, the frames stay views
+        frames = (frame[..., 0] for frame in frames)
+    return frames
+
+
+def _frame_rate(v_path):
+    return get_metadata(v_path).fps
+
+
+def _read_range(v_path, start_idx, end_idx, fps, outputdict):
+    if start_idx == 0:
+        return skvideo.io.vreader(v_path, num_frames=end_idx + 1,
+                                  outputdict=outputdict)
+
+    # seek half a frame early so rounding never skips the first frame, and
+    # pass timestamps through so ffmpeg doesn't duplicate it to fill the gap
+    inputdict = {'-ss': '{0:.6f}'.format((start_idx - .5) / fps)}
+    outputdict = dict(outputdict, **{'-vsync': '0'})
+    return skvideo.io.vreader(v_path, num_frames=end_idx - start_idx + 1,
+                              inputdict=inputdict, outputdict=outputdict)
+
+
+def _read_shards(v_path, start_idx, end_idx, fps, n_shards, shard_size,
+                 outputdict):
+    """
+    DESCRIPTION:
+        Decodes consecutive shards of shard_size frames in up to n_shards
+        ffmpeg processes at once and yields their frames in order. The next
+        shard is started when one is handed over, so at most n_shards + 1
+        decoded shards are held: the one being yielded and n_shards being
+        decoded.
+    """
+    shards = iter([(first, min(first + shard_size - 1, end_idx))
+                   for first in range(start_idx, end_idx + 1, shard_size)])
+
+    def decode(shard):
+        return list(_read_range(v_path, shard[0], shard[1], fps,
+                                outputdict))
+
+    pool = concurrent.futures.ThreadPoolExecutor(n_shards)
+    pending = collections.deque(pool.submit(decode, shard)
+                                for shard in itertools.islice(shards,
+                                                              n_shards))
+    try:
+        while pending:
+            frames = pending.popleft().result()
+            shard = next(shards, None)
+            if shard is not None:
+                pending.append(pool.submit(decode, shard))
+            yield from frames
+            del frames
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def cached_frames(v_path, start_idx, end_idx, cache_dir, seek=False,
+                  n_shards=1, shard_size=128, outputdict=None):
+    """
+    DESCRIPTION:
+        Memory maps the frames start_idx..end_idx of a video from the
+        decode cache, decoding them into it first if they are not cached.
+        The cache file is written under a temporary name and renamed when
+        complete, so concurrent jobs never read half a file.
+
+    ARGS:
+        :v_path: Path to MPEG video
+        :start_idx: Index of the first frame (integer >= 0)
+        :end_idx: Index of the last frame (integer >= start_idx)
+        :cache_dir: directory holding the cache files
+        :seek: seek to start_idx when decoding, see iter_mpeg_batches
+        :n_shards: number of shards decoded concurrently, see
+                  iter_mpeg_batches
+        :shard_size: number of frames per shard
+        :outputdict: ffmpeg output parameters, see output_params
+
+    RETURNS:
+        read only (frames x length x width x channels) np.memmap, shorter
+        than the range if the video is
+    """
+    outputdict = outputdict or {}
+    # input seeking (also used by shards) is inexact on variable frame
+    # rate videos, so its frames are never served to an exact decode
+    seeked = bool(seek and start_idx > 0) or n_shards > 1
+    params = (start_idx, end_idx, seeked) + \
+        tuple(sorted(outputdict.items()))
+    path = _cache_path(v_path, cache_dir, params)
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+        os.close(fd)
+        try:
+            frames = read_frames(v_path, start_idx, end_idx, seek=seek,
+                                 n_shards=n_shards, shard_size=shard_size,
+                                 outputdict=outputdict)
+            _decode_to_npy(frames, start_idx, end_idx, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return np.load(path, mmap_mode='r')
+
+
+def _cache_path(v_path, cache_dir, params):
+    # the file is identified by its path, size and mtime, so an edited
+    # video gets a new cache entry
+    v_path = os.path.abspath(v_path)
+    stat = os.stat(v_path)
+    key = (v_path, stat.st_size, stat.st_mtime_ns) + tuple(params)
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    name = os.path.splitext(os.path.basename(v_path))[0]
+    return os.path.join(cache_dir, '{0}-{1}.npy'.format(name, digest))
+
+
+def _decode_to_npy(decoded, start_idx, end_idx, path):
+    out = None
+    count = 0
+    for frame in decoded:
+        if out is None:
+            out = np.lib.format.open_memmap(
+                path, mode='w+', dtype=frame.dtype,
+                shape=(end_idx - start_idx + 1,) + frame.shape)
+        out[count] = frame
         count += 1
+
+    if out is None:
+        # nothing to batch, like decoding past the end of the video
+        np.save(path, np.empty(0, dtype=np.uint8))
+        return
+    out.flush()
+    if count < len(out):
+        # video is shorter than its metadata says, keep what we have
+        frames = np.array(out[:count])
+        del out
+        np.save(path, frames)
+
+
+def _iter_cached_batches(frames, start_idx, batch_size, stride, pad, ring,
+                         stop=None):
+    """
+    DESCRIPTION:
+        iter_mpeg_batches over memory mapped frames, same batches as
+        _iter_batches. Full batches are slices of the memory map.
+    """
+    end_idx = start_idx + len(frames) - 1
+    for first, last in batch_windows(start_idx, end_idx, batch_size, stride):
+        batch = frames[first - start_idx:last - start_idx]
+        if ring is not None:
+            yield _write_slot(ring, batch, stop)
+        elif len(batch) < batch_size:
+            yield np.array(pad_batch(list(batch), batch_size, batch[-1],
+                                     pad=pad))
+        else:
+            yield batch
+
+
+def _write_slot(ring, batch, stop=None):
+    # copy the frames into a free slot, zero padded, no batch array in
+    # between. Waiting for the slot ends with TimeoutError once stop is set.
+    while True:
+        try:
+            slot = ring.acquire(timeout=0.1 if stop is not None else None)
+            break
+        except TimeoutError:
+            if stop.is_set():
+                raise
+    out = ring[slot]
+    try:
+        for i, frame in enumerate(batch):
+            out[i] = frame
+        out[len(batch):] = 0
+    except Exception:
+        ring.release(slot)
+        raise
+    return slot
+
+
+def decode_mpeg(v_path, batch_size=1, stride=1, start_idx=0, end_idx=-1,
+                pad=True, cache_dir=None, seek=False, n_shards=1,
+                shard_size=128, gray=False, size=None, scale=None,
+                crop=None):
+    """
+    DESCRIPTION:
+        Creates a list of batches of frames from an MPEG file. See
+        iter_mpeg_batches to decode batches lazily instead.
+
+    ARGS:
+        :v_path: Path to MPEG video (i.e. include the video's name &
+                extension)
+        :batch_size: Number of frames in each batch
+        :stride: Stride indicates beginning of batches, i.e. every stride'th
+                frame (integer > 1)
+        :start_idx: Index of first frame for first batch (integer >= 0)
+        :end_idx: Index of last frame in the range of interest (integer >= 0)
+        :pad: Boolean value indicating whether the last batch should be
+             padded if it is not full after decoding the mpeg
+        :cache_dir: optional decode cache directory, see iter_mpeg_batches
+        :seek: seek to start_idx instead of decoding from the first frame,
+              see iter_mpeg_batches
+        :n_shards: number of shards decoded concurrently, see
+                  iter_mpeg_batches
+        :shard_size: number of frames per shard
+        :gray: decode to grayscale, see iter_mpeg_batches
+        :size: (height, width) to scale the frames to while decoding
+        :scale: factor to scale the frames by, instead of size
+        :crop: (top, left, height, width) region to keep, before scaling
+
+    RETURNS:
+        LIST of NUMPY batches of frames (length x width x channels), and
+        if the last batch is not full, it is padded with frames of:
+        np.zeros((frame.shape))
+
+    """
+    return list(iter_mpeg_batches(v_path, batch_size=batch_size,
+                                  stride=stride, start_idx=start_idx,
+                                  end_idx=end_idx, pad=pad,
+                                  cache_dir=cache_dir, seek=seek,
+                                  n_shards=n_shards, shard_size=shard_size,
+                                  gray=gray, size=size, scale=scale,
+                                  crop=crop))
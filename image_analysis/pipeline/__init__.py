@@ -1,5 +1,13 @@
 from .pipeline import Pipeline
 from .fft import FFT
+from .fft import load_wisdom
+from .fft import save_wisdom
 from .feature import Feature
+from .frame import Frame
+from .feature_store import FeatureStore
+from .ring_buffer import FrameRingBuffer
+from .filter_cache import FilterCache
+from .filter_cache import filter_cache
 from .orientation_filter import OrientationFilter
+from .orientation_filter import BatchOrientationFilter
 from .svm import SVM
\ No newline at end of file
@@ -25,13 +25,19 @@ class Feature:
         :batch_op: boolean to say the feature runs on batches of frames
         :frame_op: boolean to say the feature runs on each frame
         :save: boolean check to save feature in output dict
+        :inputs: key names of the frame ops (or Pipeline intermediates)
+                 whose outputs a frame op takes, extract is called with
+                 their values in this order. 'input' is the input frame,
+                 None takes just the input frame.
     """
 
-    def __init__(self, key_name, batch_op=False, frame_op=False, save=False):
+    def __init__(self, key_name, batch_op=False, frame_op=False, save=False,
+                 inputs=None):
         self.batch_op = batch_op
         self.frame_op = frame_op
         self.key_name = key_name
         self.save = save
+        self.inputs = inputs
 
     def extract(self, **args):
         """
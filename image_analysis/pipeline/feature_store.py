@@ -0,0 +1,223 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import numbers
+from collections.abc import Sequence
+import numpy as np
+from .frame import Frame
+
+
+class Column:
+    """
+    DESCRIPTION:
+        Growable column of values. Arrays and numbers of a fixed shape and
+        dtype are copied into one preallocated contiguous array that
+        doubles its capacity when full, anything else (or a value whose
+        shape/dtype changes) makes the column fall back to a list.
+
+    ARGS:
+        :capacity: initial number of rows
+        :copy: False keeps references in a list instead of copying values
+               (used for the input frames, which already live in the
+               batches)
+    """
+    def __init__(self, capacity=64, copy=True):
+        self.capacity = capacity
+        self.copy = copy
+        self.data = None       # preallocated array, None when a list
+        self.values = None     # list fallback
+        self.length = 0
+
+    def append(self, value):
+        """
+        DESCRIPTION:
+            add one row
+
+        ARGS:
+            :value: feature value
+        """
+        if self.values is None and self.copy:
+            if self.data is None and self.length == 0:
+                if isinstance(value, (np.ndarray, np.generic,
+                                      numbers.Number)):
+                    value = np.asarray(value)
+                    self.data = np.empty((self.capacity,) + value.shape,
+                                         dtype=value.dtype)
+            if self.data is not None and self._fits(value):
+                if self.length == len(self.data):
+                    self._grow()
+                self.data[self.length] = value
+                self.length += 1
+                return
+            self._to_list()
+
+        if self.values is None:
+            self.values = []
+        self.values.append(value)
+        self.length += 1
+
+    def as_ndarray(self):
+        """
+        DESCRIPTION:
+            the column as a numpy array, a view without copying unless the
+            column fell back to a list
+
+        RETURNS:
+            (len x ...) numpy array
+        """
+        if self.data is not None:
+            return self.data[:self.length]
+        return np.array(self.values if self.values is not None else [])
+
+    def __getitem__(self, idx):
+        if not -self.length <= idx < self.length:
+            raise IndexError('column index out of range')
+        if self.data is not None:
+            return self.data[idx % self.length]
+        return self.values[idx]
+
+    def __len__(self):
+        return self.length
+
+    def _fits(self, value):
+        if isinstance(value, np.ndarray):
+            return (value.shape == self.data.shape[1:] and
+                    value.dtype == self.data.dtype)
+        if isinstance(value, (np.generic, numbers.Number)):
+            return (self.data.ndim == 1 and
+                    np.asarray(value).dtype == self.data.dtype)
+        return False
+
+    def _grow(self):
+        data = np.empty((2 * len(self.data),) + self.data.shape[1:],
+                        dtype=self.data.dtype)
+        data[:self.length] = self.data[:self.length]
+        self.data = data
+
+    def _to_list(self):
+        if self.data is not None:
+            self.values = list(self.data[:self.length])
+            self.data = None
+        else:
+            self.values = []
+
+
+class FeatureStore(Sequence):
+    """
+    DESCRIPTION:
+        Columnar output of Pipeline.extract. Every frame, batch and seq
+        feature key (and each meta_data key) gets its own Column, batch
+        features are stored once per batch. It reads like the old list of
+        frame dicts: len(store), store[i] and iteration give Frame records.
+        Each Frame is built on first access and then kept, so edits such
+        as store[0]['seq_output'] = x persist like they did in the list.
+        The columns (and as_ndarray) keep the extracted values.
+
+    ARGS:
+        :capacity: initial number of rows of each column
+    """
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.input = Column(capacity, copy=False)
+        self.seq_output = Column(capacity)
+        self.meta_data = {}
+        self.frame_features = {}
+        self.seq_features = {}
+        self.batch_features = {}
+        # row of each frame's batch in the batch feature columns
+        self.batch_rows = Column(capacity)
+        self._batch_row = {}    # batch_number -> row
+        self._frames = []       # Frames built so far, None until accessed
+
+    def append(self, frame):
+        """
+        DESCRIPTION:
+            add the features of one frame, batch features are added with
+            the first frame of each batch
+
+        ARGS:
+            :frame: Frame (or frame dict) from Pipeline.extract_iter
+        """
+        self.input.append(frame['input'])
+        self.seq_output.append(frame['seq_output'])
+        self._append(self.meta_data, frame['meta_data'])
+        self._append(self.frame_features, frame['frame_features'])
+        self._append(self.seq_features, frame['seq_features'])
+
+        batch_number = frame['meta_data']['batch_number']
+        if batch_number not in self._batch_row:
+            self._batch_row[batch_number] = len(self._batch_row)
+            self._append(self.batch_features, frame['batch_features'])
+        self.batch_rows.append(self._batch_row[batch_number])
+        self._frames.append(None)
+
+    def as_ndarray(self, field, key):
+        """
+        DESCRIPTION:
+            get a feature as a numpy array, one row per frame
+
+        ARGS:
+            :field: 'frame_features', 'batch_features', 'seq_features' or
+                   'meta_data'
+            :key: feature key
+
+        RETURNS:
+            numpy array, a view of the column except for batch features
+            (gathered per frame) and columns that fell back to lists
+        """
+        if field == 'batch_features':
+            rows = self.batch_rows.as_ndarray()
+            return self.batch_features[key].as_ndarray()[rows]
+        return getattr(self, field)[key].as_ndarray()
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if not -len(self) <= idx < len(self):
+            raise IndexError('store index out of range')
+        idx %= len(self)
+        if self._frames[idx] is None:
+            self._frames[idx] = self._frame(idx)
+        return self._frames[idx]
+
+    def __len__(self):
+        return len(self.input)
+
+    def _frame(self, idx):
+        meta_data = {key: _item(column[idx])
+                     for key, column in self.meta_data.items()}
+        row = self.batch_rows[idx]
+        return Frame(self.input[idx], meta_data,
+                     {key: column[row]
+                      for key, column in self.batch_features.items()},
+                     {key: column[idx]
+                      for key, column in self.frame_features.items()},
+                     {},
+                     {key: column[idx]
+                      for key, column in self.seq_features.items()},
+                     self.seq_output[idx])
+
+    def _append(self, columns, features):
+        for key, value in features.items():
+            if key not in columns:
+                columns[key] = Column(self.capacity)
+            columns[key].append(value)
+
+
+def _item(value):
+    # meta data numbers go back to python ints
+    return value.item() if isinstance(value, np.generic) else value
@@ -14,10 +14,80 @@
 # ==============================================================================
 
 
+import atexit
+import os
+import tempfile
+import numpy as np
 import pyfftw
 from pyfftw.interfaces.numpy_fft import fftshift
 from .feature import Feature
 
+# (real, complex) dtypes of each supported precision
+precisions = {'double': ('float64', 'complex128'),
+              'single': ('float32', 'complex64')}
+
+
+# wisdom files of FFT(wisdom_path=...), saved when the interpreter exits
+wisdom_paths = set()
+
+
+def load_wisdom(path):
+    """
+    DESCRIPTION:
+        Imports fftw wisdom saved by save_wisdom, so plans that were already
+        measured on this machine are built without planning again. The file
+        is the plain text fftw exports, which fftw parses itself, so a
+        tampered file can at worst hold bad wisdom.
+
+    ARGS:
+        :path: wisdom file
+
+    RETURNS:
+        True if the file existed and fftw accepted it
+    """
+    if not os.path.exists(path):
+        return False
+
+    with open(path, 'rb') as f:
+        wisdom = tuple(f.read().split(b'\0'))
+    # one text per precision (double, single, long double)
+    if len(wisdom) != len(pyfftw.export_wisdom()):
+        return False
+    return all(pyfftw.import_wisdom(wisdom))
+
+
+def save_wisdom(path):
+    """
+    DESCRIPTION:
+        Exports the fftw wisdom of this process (every plan made so far) to
+        a file. Wisdom already in the file is imported first, so processes
+        sharing the file add to it instead of dropping each other's plans,
+        and the file is replaced atomically.
+
+    ARGS:
+        :path: wisdom file
+    """
+    load_wisdom(path)
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # fftw wisdom is text, it never holds a NUL byte
+            f.write(b'\0'.join(pyfftw.export_wisdom()))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@atexit.register
+def _save_wisdom_paths():
+    for path in wisdom_paths:
+        try:
+            save_wisdom(path)
+        except OSError:
+            pass
+
 
 class FFT(Feature):
     """
@@ -26,59 +96,197 @@ class FFT(Feature):
 
     ARGS:
         :inputshape: we need to know in advance the shape of input for
-                     performance reason
+                     performance reason. A (N x m x n) shape plans a batch
+                     of N frames, transformed over the last two axes in
+                     one plan execution
         :usegpu: #TODO use gpu for implementation or not
         :nthreads: number of threads to run fft in multhreaded mode
+        :real: plan real to complex transforms (rfft2/irfft2) for real
+               input. The spectrum only holds the non negative frequencies
+               of the last axis, shape (..., inputshape[-1] // 2 + 1), which
+               halves the work and memory of the transforms.
+        :precision: 'double' (float64/complex128) or 'single'
+                    (float32/complex64). Input of another dtype is converted
+                    when it is copied into the plan.
+        :planner_effort: fftw planner flag, e.g. 'FFTW_ESTIMATE',
+                         'FFTW_MEASURE' or 'FFTW_PATIENT'. None uses the
+                         pyfftw default.
+        :wisdom_path: file to load fftw wisdom from before the first plan
+                      of this process and to save it to when the process
+                      exits (or on save_wisdom), so expensive planning is
+                      done once per machine
+
+    The plans own aligned buffers: input_array, spectrum_array (output of
+    fft2d), ifft_input_array and output_array (output of ifft2d). Input
+    that is already aligned with the plan's dtype and layout, e.g. one of
+    these buffers or an array from empty_input(), is transformed without a
+    copy. Without an output argument the transforms write into (and
+    return) spectrum_array and output_array, which are reused every call.
     """
-    def __init__(self, inputshape, usegpu=False, nthreads=1):
+    def __init__(self, inputshape, usegpu=False, nthreads=1, real=False,
+                 precision='double', planner_effort=None, wisdom_path=None):
         Feature.__init__(self, 'FFT', frame_op=True)
         self.usegpu = usegpu
         self.inputshape = inputshape
         self.nthreads = nthreads
+        self.real = real
+
+        if precision not in precisions:
+            raise ValueError('precision: {0} is invalid'.format(precision))
+        self.precision = precision
+        self.realdtype, self.complexdtype = precisions[precision]
+        self.planner_effort = planner_effort
+        self.wisdom_path = wisdom_path
+
+        if wisdom_path is not None and wisdom_path not in wisdom_paths:
+            load_wisdom(wisdom_path)
+            wisdom_paths.add(wisdom_path)
 
         # memory objects for input and output since pyfftw requires it
         # upfront
-        inputobj = pyfftw.empty_aligned(inputshape, dtype='complex128')
-        outputbj = pyfftw.empty_aligned(inputshape, dtype='complex128')
+        if real:
+            self.spectrumshape = tuple(inputshape[:-1]) + \
+                (inputshape[-1] // 2 + 1,)
+            inputobj = pyfftw.empty_aligned(inputshape,
+                                            dtype=self.realdtype)
+            outputbj = pyfftw.empty_aligned(self.spectrumshape,
+                                            dtype=self.complexdtype)
+
+            # rfft, irfft functions, s gives back the odd/even last axis
+            self.fft2obj = pyfftw.builders.rfft2(
+                inputobj, axes=(-2, -1), threads=nthreads,
+                planner_effort=planner_effort)
+            self.ifft2obj = pyfftw.builders.irfft2(
+                outputbj, s=inputshape[-2:], axes=(-2, -1), threads=nthreads,
+                planner_effort=planner_effort)
+        else:
+            self.spectrumshape = inputshape
+            inputobj = pyfftw.empty_aligned(inputshape,
+                                            dtype=self.complexdtype)
+            outputbj = pyfftw.empty_aligned(inputshape,
+                                            dtype=self.complexdtype)
 
-        # fft, ifft functions
-        self.fft2obj = pyfftw.builders.fft2(inputobj, threads=nthreads)
-        self.ifft2obj = pyfftw.builders.ifft2(outputbj, threads=nthreads)
+            # fft, ifft functions
+            self.fft2obj = pyfftw.builders.fft2(
+                inputobj, axes=(-2, -1), threads=nthreads,
+                planner_effort=planner_effort)
+            self.ifft2obj = pyfftw.builders.ifft2(
+                outputbj, axes=(-2, -1), threads=nthreads,
+                planner_effort=planner_effort)
+
+        # keep the planned buffers, update_arrays points the plans at
+        # caller arrays later on
+        self.input_array = self.fft2obj.input_array
+        self.spectrum_array = self.fft2obj.output_array
+        self.ifft_input_array = self.ifft2obj.input_array
+        self.output_array = self.ifft2obj.output_array
 
         # improve performance of fft by caching pyfftw fft objects
         # see https://hgomersall.github.io/pyFFTW/sphinx/tutorial.html#caveat
         pyfftw.interfaces.cache.enable()
 
-    def fft2d(self, input):
+    def fft2d(self, input, output=None):
         """
         DESCRIPTION:
             2d fast fourier transform
 
         ARGS:
-            :input: input frame to transform
+            :input: input frame (or batch of frames) to transform
+            :output: optional aligned array to write the spectrum into, see
+                    empty_spectrum
+
+        RETURNS:
+            the spectrum, output or spectrum_array if output is None
         """
         assert input.shape == self.inputshape
 
-        return self.fft2obj(input)
+        if output is None:
+            output = self.spectrum_array
+        return self._execute(self.fft2obj, self.input_array, input, output)
 
-    def ifft2d(self, input):
+    def ifft2d(self, input, output=None):
         """
         DESCRIPTION:
-            2d inverse fast fourier transform
+            2d inverse fast fourier transform. Real plans may overwrite an
+            aligned input.
 
         ARGS:
-            :input: input frame to transform
+            :input: spectrum (or batch of spectra) to transform
+            :output: optional aligned array to write the frame(s) into, see
+                    empty_output
+
+        RETURNS:
+            the frame(s), output or output_array if output is None
         """
-        assert input.shape == self.inputshape
+        assert input.shape == self.spectrumshape
+
+        if output is None:
+            output = self.output_array
+        return self._execute(self.ifft2obj, self.ifft_input_array, input,
+                             output)
+
+    def empty_input(self):
+        """
+        DESCRIPTION:
+            aligned array that fft2d reads without a copy
+        """
+        return pyfftw.empty_aligned(self.input_array.shape,
+                                    dtype=self.input_array.dtype)
+
+    def empty_spectrum(self):
+        """
+        DESCRIPTION:
+            aligned array fft2d can write into, and ifft2d reads without a
+            copy
+        """
+        return pyfftw.empty_aligned(self.spectrum_array.shape,
+                                    dtype=self.spectrum_array.dtype)
+
+    def empty_output(self):
+        """
+        DESCRIPTION:
+            aligned array ifft2d can write into
+        """
+        return pyfftw.empty_aligned(self.output_array.shape,
+                                    dtype=self.output_array.dtype)
+
+    def can_replace(self, array, buffer):
+        """
+        DESCRIPTION:
+            checks if an array can stand in for one of the plan buffers
+            without a copy, i.e. it has the same shape, dtype, layout and
+            alignment
+
+        ARGS:
+            :array: caller array
+            :buffer: one of input_array, spectrum_array, ifft_input_array
+                    or output_array
+        """
+        return (isinstance(array, np.ndarray) and
+                array.shape == buffer.shape and
+                array.dtype == buffer.dtype and
+                array.strides == buffer.strides and
+                pyfftw.is_byte_aligned(array, self.fft2obj.input_alignment))
+
+    def _execute(self, plan, buffer, input, output):
+        # transform in place of the caller's arrays when their layout
+        # matches the plan, otherwise copy the input into the plan buffer
+        if not self.can_replace(input, buffer):
+            np.copyto(buffer, input, casting='unsafe')
+            input = buffer
 
-        return self.ifft2obj(input)
+        plan.update_arrays(input, output)
+        # calling the plan (not execute) also normalizes inverse transforms
+        plan()
+        return output
 
-    def fftshift(self, input):
+    @staticmethod
+    def fftshift(input):
         """
         DESCRIPTION:
-            2d fast fourier shift
+            2d fast fourier shift, over the last two axes
 
         ARGS:
-            :input: input frame to shift
+            :input: input frame (or batch of frames) to shift
         """
-        return fftshift(input)
+        return fftshift(input, axes=(-2, -1))
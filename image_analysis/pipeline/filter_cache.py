@@ -0,0 +1,148 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import numpy as np
+
+
+class FilterCache:
+    """
+    DESCRIPTION:
+        Least recently used cache of filter arrays keyed by the parameters
+        they were built from. Arrays are kept in memory up to max_bytes and,
+        if cache_dir is set, also saved as .npy files so other processes
+        (or a restarted one) can load them instead of rebuilding.
+        Cached arrays are read only since they are shared.
+
+    ARGS:
+        :max_bytes: memory budget for cached arrays, in bytes
+        :cache_dir: optional directory for on disk .npy persistence
+    """
+    def __init__(self, max_bytes=256 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self._arrays = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_bytes=None, cache_dir=None):
+        """
+        DESCRIPTION:
+            change the memory budget and/or the on disk directory
+
+        ARGS:
+            :max_bytes: memory budget for cached arrays, in bytes
+            :cache_dir: directory for on disk .npy persistence
+        """
+        with self._lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+                self._evict()
+            if cache_dir is not None:
+                self.cache_dir = cache_dir
+
+    def get(self, key):
+        """
+        DESCRIPTION:
+            look up a filter, first in memory then on disk
+
+        ARGS:
+            :key: hashable tuple of the filter parameters
+
+        RETURNS:
+            the cached array or None if it is not cached
+        """
+        with self._lock:
+            if key in self._arrays:
+                self._arrays.move_to_end(key)
+                return self._arrays[key]
+
+        path = self._path(key)
+        if path is None or not os.path.exists(path):
+            return None
+
+        array = np.load(path)
+        with self._lock:
+            self._add(key, array)
+        return array
+
+    def put(self, key, array):
+        """
+        DESCRIPTION:
+            add a filter to the cache (and to cache_dir if set)
+
+        ARGS:
+            :key: hashable tuple of the filter parameters
+            :array: filter array
+
+        RETURNS:
+            the cached, read only array
+        """
+        path = self._path(key)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temporary file first so readers never see half of
+            # an array
+            fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        with self._lock:
+            return self._add(key, array)
+
+    def clear(self):
+        """
+        DESCRIPTION:
+            drop all in memory filters, files in cache_dir are kept
+        """
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+    def _add(self, key, array):
+        array = np.asarray(array)
+        array.flags.writeable = False
+        if key in self._arrays:
+            self.nbytes -= self._arrays.pop(key).nbytes
+        if array.nbytes <= self.max_bytes:
+            self._arrays[key] = array
+            self.nbytes += array.nbytes
+            self._evict()
+        return array
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, array = self._arrays.popitem(last=False)
+            self.nbytes -= array.nbytes
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.npy')
+
+
+# process wide cache used by OrientationFilter
+filter_cache = FilterCache()
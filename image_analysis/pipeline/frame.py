@@ -0,0 +1,82 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+from collections.abc import Mapping
+
+
+class Frame(Mapping):
+    """
+    DESCRIPTION:
+        Per frame record filled by Pipeline.extract. The fields live in
+        slots instead of a nested dict, so building one costs a handful of
+        attribute stores, but a Frame still reads like the old frame dict:
+        frame['frame_features'], frame.keys(), frame == {...} all work, and
+        fields can be replaced with frame['seq_output'] = ...
+
+    ARGS:
+        :input: the input frame
+        :meta_data: dict with frame_number and batch_number
+        :batch_features: dict of batch op key_name -> feature
+        :frame_features: dict of frame op key_name -> feature
+        :seq: dict, unused by the pipeline, kept for compatibility
+        :seq_features: dict of seq op key_name -> feature (None if the op is
+                       not saved)
+        :seq_output: output of the last seq op
+    """
+    __slots__ = ('input', 'meta_data', 'batch_features', 'frame_features',
+                 'seq', 'seq_features', 'seq_output')
+
+    def __init__(self, input=None, meta_data=None, batch_features=None,
+                 frame_features=None, seq=None, seq_features=None,
+                 seq_output=None):
+        self.input = {} if input is None else input
+        self.meta_data = {} if meta_data is None else meta_data
+        self.batch_features = {} if batch_features is None else \
+            batch_features
+        self.frame_features = {} if frame_features is None else \
+            frame_features
+        self.seq = {} if seq is None else seq
+        self.seq_features = {} if seq_features is None else seq_features
+        self.seq_output = {} if seq_output is None else seq_output
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return 'Frame({})'.format(self.to_dict())
+
+    def to_dict(self):
+        """
+        DESCRIPTION:
+            plain dict copy of the record, in the old frame dict layout
+
+        RETURNS:
+            dict of field name -> value
+        """
+        return {key: getattr(self, key) for key in self.__slots__}
@@ -14,10 +14,22 @@
 # ==============================================================================
 
 
+import collections
+import threading
 import numpy as np
 from skimage.color import rgb2gray
+from skimage.util import img_as_float
 from .fft import FFT
 from .feature import Feature
+from .filter_cache import filter_cache
+
+# skimage.color.rgb2gray weights of the red, green and blue channels
+luma_weights = np.array([0.2125, 0.7154, 0.0721])
+
+# part of the filter cache key, bump it whenever the way filters are built
+# (make_filter, bowtie, noise_amp, triangle) changes so filters saved in a
+# cache_dir by an older version are not served
+filter_version = 1
 
 
 class OrientationFilter(Feature):
@@ -28,7 +40,9 @@ class OrientationFilter(Feature):
             frequencies.
 
     ARGS:
-        :inputshape: shape of then input for pyfftw builder
+        :inputshape: shape of the input frames for the pyfftw builder. If
+                    None it is inferred from each frame, so one filter can
+                    process frames of different sizes
         :center_orientation: int for the center orientation (0-180)
         :orientation_width: int for the orientation width of the filter
         :high_cutoff: int high spatial frequency cutoff
@@ -37,14 +51,30 @@ class OrientationFilter(Feature):
         :falloff: string 'triangle' or 'rectangle' shape of the filter
                 falloff from the center.
         :nthreads: number of multithreads
+        :real_fft: filter with real to complex transforms (rfft2/irfft2) and
+                  half spectrum filters, which is about twice as fast and
+                  gives the same frames up to rounding
+        :precision: 'double' or 'single'. Single precision runs the
+                   transforms, filter and output in float32/complex64,
+                   halving memory traffic at ~1e-6 relative error.
+        :planner_effort: fftw planner flag for the fft plans, see FFT
+        :wisdom_path: fftw wisdom file shared by the fft plans, see FFT
+        :inputs: key of the frame op or Pipeline intermediate to filter
+                instead of the input frame, e.g. a shared grayscale frame
     """
+    # number of frame shapes to keep fft plans for
+    max_plans = 4
+    # ndim of grayscale input, e.g. from decode_mpeg(..., gray=True)
+    gray_ndim = 2
 
     def __init__(self, mask='bowtie', center_orientation=90,
                  orientation_width=20, high_cutoff=None, low_cutoff=.1,
-                 target_size=None, falloff=''):
+                 target_size=None, falloff='', inputshape=None, nthreads=4,
+                 real_fft=True, precision='double', planner_effort=None,
+                 wisdom_path=None, inputs=None):
 
         Feature.__init__(self, mask + '_filter', frame_op=True,
-                         batch_op=False)
+                         batch_op=False, inputs=inputs)
 
         self.mask = mask
         available_mask = ['bowtie', 'noise']
@@ -55,32 +85,166 @@ class OrientationFilter(Feature):
             raise ValueError('Can\'t set orientation_width to 0 because ' +
                              'it will cause a division by zero in triangle ' +
                              'filter code.')
-        # TODO: make this a parameter
-        inputshape = (480, 640)
         self.center_orientation = center_orientation
         self.orientation_width = orientation_width
         self.high_cutoff = high_cutoff
         self.low_cutoff = low_cutoff
         self.target_size = target_size
-        self.fft = FFT(inputshape=inputshape, nthreads=4)
+        self.nthreads = nthreads
+        self.real_fft = real_fft
+        self.precision = precision
+        self.planner_effort = planner_effort
+        self.wisdom_path = wisdom_path
+        # fft plans and cropped filters per frame shape, per thread
+        self._local = threading.local()
 
         self.falloff = falloff or 'triangle'
         available_falloff = ['rectangle', 'triangle']
         if self.falloff not in available_falloff:
             raise ValueError('falloff: {0} is invalid'.format(self.falloff))
 
+        # filters only depend on the class (subclasses may build them
+        # differently), filter_version and these parameters, so identical
+        # filters (e.g. in orientation sweeps) are built once per process
+        key = (filter_version, type(self).__module__,
+               type(self).__qualname__, mask, center_orientation,
+               orientation_width, high_cutoff, low_cutoff, target_size,
+               falloff)
+        self.full_filter = filter_cache.get(key)
+        if self.full_filter is None:
+            self.full_filter = filter_cache.put(key,
+                                                self.make_filter(falloff))
+        self.filter = self.full_filter
+
+        if inputshape is not None:
+            inputshape = tuple(inputshape)
+            self.fft = self.plan(inputshape)[0]
+            # cropped on the last two axes like plan, so batched shapes
+            # (N, H, W) work too
+            self.filter = self.full_filter[:inputshape[-2], :inputshape[-1]]
+
+    @property
+    def plans(self):
+        """
+        DESCRIPTION:
+            the plans of the calling thread. The plans own the transform
+            buffers, so threads running the same filter each get their own.
+        """
+        local = self._local
+        if not hasattr(local, 'plans'):
+            local.plans = collections.OrderedDict()
+            local.fft = None
+        return local.plans
+
+    @property
+    def fft(self):
+        """
+        DESCRIPTION:
+            the FFT last used by the calling thread
+        """
+        self.plans
+        return self._local.fft
+
+    @fft.setter
+    def fft(self, fft):
+        self.plans
+        self._local.fft = fft
+
+    def __getstate__(self):
+        # fftw plans can't be pickled, they are rebuilt in the new process
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def make_filter(self, falloff=''):
+        """
+        DESCRIPTION:
+            Builds the full (target_size x target_size) filter for the mask.
+
+        ARGS:
+            :falloff: string 'triangle' or 'rectangle' shape of the filter
+                    falloff from the center.
+
+        RETURNS:
+            the filter, ready to multiply an unshifted spectrum
+        """
         if self.mask == 'bowtie':
-            self.filter = self.bowtie(center_orientation, orientation_width,
-                                      high_cutoff, low_cutoff, target_size,
-                                      falloff)
-            self.filter = 1 - self.filter
-            self.filter = self.fft.fftshift(self.filter)
+            filt = self.bowtie(self.center_orientation,
+                               self.orientation_width, self.high_cutoff,
+                               self.low_cutoff, self.target_size, falloff)
+            filt = 1 - filt
+            filt = FFT.fftshift(filt)
         elif self.mask == 'noise':
-            self.filter = self.noise_amp(target_size)
+            filt = self.noise_amp(self.target_size)
         else:
             raise ValueError('invalid mask: {0}'.format(self.mask))
 
-        self.filter = self.filter[:inputshape[0], :inputshape[1]]
+        return filt
+
+    def plan(self, shape):
+        """
+        DESCRIPTION:
+            Gets the fft plan and the filter cropped to a frame shape. Plans
+            are built once per shape and the max_plans most recently used
+            ones are kept.
+
+        ARGS:
+            :shape: (rows, columns) of the frames to filter, or
+                   (frames, rows, columns) to filter a batch at once
+
+        RETURNS:
+            (FFT, filter, phase) for that shape. The filter matches the
+            spectrum of the FFT, phase is a real scratch array of the same
+            shape for the noise mask (None for other masks).
+        """
+        if shape in self.plans:
+            self.plans.move_to_end(shape)
+            return self.plans[shape]
+
+        if shape[-2] > self.full_filter.shape[0] or \
+                shape[-1] > self.full_filter.shape[1]:
+            raise ValueError('frame shape {0} is larger than the filter '
+                             'shape {1}'.format(shape,
+                                                self.full_filter.shape))
+
+        fft = FFT(inputshape=shape, nthreads=self.nthreads,
+                  real=self.real_fft, precision=self.precision,
+                  planner_effort=self.planner_effort,
+                  wisdom_path=self.wisdom_path)
+        filt = self.full_filter[:shape[-2], :shape[-1]]
+        if self.real_fft:
+            filt = self.half_spectrum(filt)
+        phase = None
+        if self.mask == 'noise':
+            phase = np.empty(fft.spectrumshape, dtype=fft.realdtype)
+        plan = (fft, filt.astype(fft.realdtype), phase)
+        self.plans[shape] = plan
+        if len(self.plans) > self.max_plans:
+            self.plans.popitem(last=False)
+        return plan
+
+    def half_spectrum(self, filt):
+        """
+        DESCRIPTION:
+            Converts a filter for the full spectrum into one for the rfft2
+            spectrum of a real frame. The real part of the complex inverse
+            transform only sees the point symmetric part of the filter,
+            (F(k) + F(-k)) / 2, so that is kept for the non negative
+            frequencies of the last axis.
+
+        ARGS:
+            :filt: (m x n) filter for the unshifted full spectrum
+
+        RETURNS:
+            (m x n // 2 + 1) filter for the rfft2 spectrum
+        """
+        mirrored = np.roll(filt[::-1, ::-1], 1, axis=(0, 1))
+        filt = (filt + mirrored) / 2
+        return filt[:, :filt.shape[1] // 2 + 1]
 
     def bowtie(self, center_orientation, orientation_width, high_cutoff,
                low_cutoff, target_size, falloff=''):
@@ -115,7 +279,7 @@ class OrientationFilter(Feature):
         radii = np.concatenate((radii, flipped_radii), axis=1)
         flipped_radii = np.flipud(radii[1:target_size // 2, :])
         radii = np.concatenate((radii, flipped_radii), axis=0)
-        radii = self.fft.fftshift(radii)
+        radii = FFT.fftshift(radii)
         # note: the right-most column and bottom-most row were sliced off
 
         # using theta for one quadrant, build the other 3 quadrants
@@ -154,33 +318,18 @@ class OrientationFilter(Feature):
         theta = theta[0:target_size, 0:target_size]
 
         # dim's
-        anfilter = np.zeros(theta.shape)
         sffilter = (low_cutoff <= radii) & (radii <= high_cutoff)
 
-        if falloff is 'rectangle':
+        if falloff == 'rectangle':
             anfilter = ((ccwb1 <= theta) & (theta <= cwb1)) | (
                 (ccwb2 <= theta) & (theta <= cwb2))
             # filt = sffiler*anfilter
-        elif falloff is 'triangle':
-            for idx, val in np.ndenumerate(theta):
-                if ccwb1 <= val <= cwb1 and val <= center_orientation:
-                    anfilter[idx] = (val - center_orientation +
-                                     orientation_width / 2) * \
-                        2 / orientation_width
-                elif ccwb1 <= val <= cwb1 and val > center_orientation:
-                    anfilter[idx] = (-val + center_orientation +
-                                     orientation_width / 2) * \
-                        2 / orientation_width
-                elif ccwb2 <= val <= cwb2 and val <= center_orientation_2:
-                    anfilter[idx] = (val - center_orientation_2 +
-                                     orientation_width / 2) \
-                        * 2 / orientation_width
-                elif ccwb2 <= val <= cwb2 and val > center_orientation_2:
-                    anfilter[idx] = (-val + center_orientation_2 +
-                                     orientation_width / 2) \
-                        * 2 / orientation_width
-                else:
-                    anfilter[idx] = 0
+        elif falloff == 'triangle':
+            anfilter = self.triangle(theta,
+                                     [center_orientation,
+                                      center_orientation_2],
+                                     [(ccwb1, cwb1), (ccwb2, cwb2)],
+                                     orientation_width)
         else:
             angfilter1 = np.exp(-((theta - center_orientation) /
                                   (.5 * orientation_width)) ** 4)
@@ -190,6 +339,37 @@ class OrientationFilter(Feature):
 
         return sffilter * anfilter
 
+    def triangle(self, theta, center_orientations, bounds,
+                 orientation_width):
+        """
+        DESCRIPTION:
+            Triangle shaped angular falloff: ramps linearly from 0 at the
+            edges of each orientation band up to 1 at its center. Where bands
+            overlap, the first matching band wins.
+
+        ARGS:
+            :theta: array of orientations in degrees
+            :center_orientations: list with the center of each band
+            :bounds: list of (counterclockwise, clockwise) cutoffs, one per
+                    band
+            :orientation_width: int for the orientation width of the filter
+
+        RETURNS:
+            the angular filter, same shape as theta
+        """
+        conditions = []
+        choices = []
+        for center, (ccwb, cwb) in zip(center_orientations, bounds):
+            band = (ccwb <= theta) & (theta <= cwb)
+            conditions.append(band & (theta <= center))
+            choices.append((theta - center + orientation_width / 2) *
+                           2 / orientation_width)
+            conditions.append(band & (theta > center))
+            choices.append((-theta + center + orientation_width / 2) *
+                           2 / orientation_width)
+
+        return np.select(conditions, choices, default=0)
+
     def noise_amp(self, size):
         """
         DESCRIPTION:
@@ -209,26 +389,30 @@ class OrientationFilter(Feature):
         xgrid = np.subtract(xgrid, size // 2)
         ygrid = np.subtract(ygrid, size // 2)
 
-        amp = self.fft.fftshift(np.divide(np.sqrt(np.square(xgrid) +
-                                          np.square(ygrid)),
-                                          size * np.sqrt(2)))
+        amp = FFT.fftshift(np.divide(np.sqrt(np.square(xgrid) +
+                                             np.square(ygrid)),
+                                     size * np.sqrt(2)))
         amp = np.rot90(amp, 2)
         amp[0, 0] = 1
         amp = 1 / amp**slope
         amp[0, 0] = 0
         return amp
 
-    def extract(self, frame):
+    def extract(self, frame, out=None):
         """
         DESCRIPTION:
             Transforms a matrix using FFT, multiplies the result by a mask, and
             then transforms the matrix back using Inverse FFT.\n
+            With out given nothing is allocated once the plan for the frame
+            shape exists.
 
         ARGS:
-            :input_frame: (m x n) numpy array
+            :input_frame: (m x n x 3) numpy array, or (m x n) if it is
+                         already grayscale
             :mask: int determining the type of filter to implement, where
                   1 = iso (noize amp) and 2 = horizontal decrement
                   (bowtie)
+            :out: optional (m x n) array to write the filtered frame into
 
         RETURNS:
             return the transformed and processed frame
@@ -240,24 +424,126 @@ class OrientationFilter(Feature):
         # https://github.com/CoDaS-Lab/IsoVideo/blob/master/isovideo/filter.py#L27
         # assert frame.shape[1] == self.target_size
 
-        # fft spectrum
-        altimg = None
-        grayframe = rgb2gray(frame)
-        dft_frame = self.fft.fft2d(grayframe)
-        phase = np.arctan2(dft_frame.imag, dft_frame.real)
+        shape = frame.shape
+        if frame.ndim != self.gray_ndim:
+            shape = shape[:-1]
+        fft = self.plan(shape)[0]
+        gray = self.rgb2gray(frame, fft.input_array, fft.output_array)
+        return self.filter_gray(gray, out)
 
-        # create filter
-        if self.mask == 'noise':
-            amp = np.copy(self.filter)
-            phase = np.exp(phase * 1j)
-            amp = np.multiply(phase, amp)
+    def rgb2gray(self, frame, gray, scratch):
+        """
+        DESCRIPTION:
+            skimage.color.rgb2gray that writes into an existing array. Unsigned
+            integer frames are scaled to [0, 1] like skimage does. Frames
+            that are already grayscale (same ndim as gray) are only scaled.
+
+        ARGS:
+            :frame: (... x 3) numpy array, or grayscale
+            :gray: array to write the grayscale frame into, frame.shape[:-1]
+            :scratch: array of the same shape to hold one channel
+
+        RETURNS:
+            gray
+        """
+        is_gray = frame.ndim == gray.ndim
+        if frame.dtype.kind == 'u':
+            scale = 1 / np.iinfo(frame.dtype).max
+        elif frame.dtype.kind == 'f':
+            scale = 1
+        else:
+            frame = img_as_float(frame) if is_gray else rgb2gray(frame)
+            np.copyto(gray, frame, casting='unsafe')
+            return gray
+
+        if is_gray:
+            np.multiply(frame, scale, out=gray, casting='unsafe')
+            return gray
+
+        red, green, blue = luma_weights * scale
+        np.multiply(frame[..., 0], red, out=gray, casting='unsafe')
+        np.multiply(frame[..., 1], green, out=scratch, casting='unsafe')
+        np.add(gray, scratch, out=gray)
+        np.multiply(frame[..., 2], blue, out=scratch, casting='unsafe')
+        np.add(gray, scratch, out=gray)
+        return gray
+
+    def filter_gray(self, grayframe, out=None):
+        """
+        DESCRIPTION:
+            Filters a grayscale frame, or a batch of grayscale frames with
+            one plan execution. The transforms run in the plan buffers, so
+            with out given nothing is allocated.
 
-            # inverse fft and normalize
-            altimg = self.fft.ifft2d(amp).real
-            altimg -= altimg.min()
-            altimg /= altimg.max()
+        ARGS:
+            :grayframe: (m x n) or (N x m x n) numpy array
+            :out: optional array to write the result into, same shape as
+                 grayframe
 
+        RETURNS:
+            the filtered frame(s), same shape as grayframe
+        """
+        self.fft, filt, phase = self.plan(grayframe.shape)
+        fft = self.fft
+        dft_frame = fft.fft2d(grayframe)
+        filtered = fft.ifft_input_array
+
+        if self.mask == 'noise':
+            # keep the phase, replace the amplitude with the filter
+            np.arctan2(dft_frame.imag, dft_frame.real, out=phase)
+            np.cos(phase, out=filtered.real)
+            np.sin(phase, out=filtered.imag)
+            np.multiply(filtered, filt, out=filtered)
         elif self.mask == 'bowtie':
-            altimg = self.fft.ifft2d(dft_frame * self.filter).real
+            np.multiply(dft_frame, filt, out=filtered)
+
+        if out is None:
+            out = fft.empty_output() if fft.real else \
+                np.empty(grayframe.shape, dtype=fft.realdtype)
+
+        if fft.can_replace(out, fft.output_array):
+            fft.ifft2d(filtered, out)
+        else:
+            np.copyto(out, fft.ifft2d(filtered).real, casting='unsafe')
+
+        if self.mask == 'noise':
+            # normalize each frame
+            out -= out.min(axis=(-2, -1), keepdims=True)
+            out /= out.max(axis=(-2, -1), keepdims=True)
+
+        return out
+
+
+class BatchOrientationFilter(OrientationFilter):
+    """
+    DESCRIPTION:
+        Batch op version of OrientationFilter: filters every frame of a
+        batch (e.g. from decode_mpeg) with one batched fft plan instead of
+        one plan execution per frame. Takes the same arguments as
+        OrientationFilter.
+    """
+    gray_ndim = 3
+
+    def __init__(self, *args, **kwargs):
+        OrientationFilter.__init__(self, *args, **kwargs)
+        self.batch_op = True
+        self.frame_op = False
+
+    def extract(self, batch, out=None):
+        """
+        DESCRIPTION:
+            Filters all frames of a batch at once.
+
+        ARGS:
+            :batch: (N x m x n x 3) numpy array or list of frames, or
+                   (N x m x n) if the frames are already grayscale
+            :out: optional (N x m x n) array to write the filtered frames
+                 into
+
+        RETURNS:
+            (N x m x n) numpy array of the filtered frames
+        """
+        if batch is None:
+            return ValueError('Batch is none')
 
-        return altimg
+        return OrientationFilter.extract(self, np.asarray(batch), out)
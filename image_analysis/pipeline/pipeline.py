@@ -14,9 +14,15 @@
 # ==============================================================================
 
 
+import collections
+import concurrent.futures
+import os
+import pickle
 import numpy as np
-import copy
 from .feature import Feature
+from .frame import Frame
+from .feature_store import FeatureStore
+from .ring_buffer import FrameRingBuffer
 
 
 class Pipeline:
@@ -32,20 +38,47 @@ class Pipeline:
         :seq: features to run in sequential way (output is input to another)
         :save_all: boolean check to save all features ran
         :models: dictionary of statistical models to run on the data
+        :executor: None runs the ops in the calling thread, 'thread' or
+                  'process' runs the batches on a pool of n_workers threads
+                  or processes. Output keeps frame/batch order. Processes
+                  get each batch through shared memory instead of pickling
+                  the frames, so its frames must share one shape and dtype
+                  to benefit.
+        :n_workers: pool size, defaults to the number of cpus
+        :ring: FrameRingBuffer that data refers to, i.e. data yields slot
+              indices as iter_mpeg_batches(..., ring=ring) does. Workers
+              read the slots in place and each slot is released once the
+              frames of its batch were yielded.
+        :intermediates: frame op Features whose outputs other frame ops
+                       take as inputs (see Feature inputs) but which are
+                       not saved. Each is computed once per frame, and only
+                       if some frame op needs it, and dropped as soon as
+                       its last consumer ran.
     """
     def __init__(self, data=None, ops=None, seq=None, save_all=None,
-                 models=None):
+                 models=None, executor=None, n_workers=None, ring=None,
+                 intermediates=None):
         self.data = data
+        self.ring = ring
         self.models = models
         self.save_all = save_all
 
+        if executor not in [None, 'thread', 'process']:
+            raise ValueError('executor: {0} is invalid'.format(executor))
+        self.executor = executor
+        self.n_workers = n_workers or os.cpu_count()
+        self._shared = None     # ring of the process executor
+
         self.batch_ops = None
         self.frame_ops = None
         self.seq_ops = None
+        self.intermediates = []
+        self._frame_plan = []
+        self.set_intermediates(intermediates)
         self.set_ops(ops, seq)
 
         self.empty_frame = {}           # Defined by set method below.
-        self.output = []          # Output data structure of the pipeline.
+        self.output = []          # Output FeatureStore of the pipeline.
 
     def set_ops(self, ops=None, seq=None):
         """
@@ -82,6 +115,7 @@ class Pipeline:
         self.batch_ops = batch_ops
         self.frame_ops = frame_ops
         self.seq_ops = seq
+        self._frame_plan = self.plan_frame_ops()
 
     def set_batch_ops(self, batch_ops=None):
         """
@@ -99,6 +133,7 @@ class Pipeline:
             assert op.batch_op
 
         self.batch_ops = batch_ops
+        self._frame_plan = self.plan_frame_ops()
 
     def set_frame_ops(self, frame_ops=None):
         """
@@ -116,6 +151,90 @@ class Pipeline:
             assert op.frame_op
 
         self.frame_ops = frame_ops
+        self._frame_plan = self.plan_frame_ops()
+
+    def set_intermediates(self, intermediates=None):
+        """
+        DESCRIPTION:
+            update the shared intermediate frame ops
+
+        ARGS:
+            :intermediates: features frame ops can take as inputs
+        """
+        if intermediates is None:
+            intermediates = []
+
+        for op in intermediates:
+            assert isinstance(op, Feature)
+            assert op.frame_op
+
+        self.intermediates = intermediates
+        self._frame_plan = self.plan_frame_ops()
+
+    def plan_frame_ops(self):
+        """
+        DESCRIPTION:
+            orders the frame ops and the intermediates they need so every
+            op runs after its inputs (a topological sort of the graph of
+            inputs), and finds the op after which each intermediate is no
+            longer needed
+
+        RETURNS:
+            list of (op, input keys, whether op is a frame op (saved),
+            intermediate keys to drop after op)
+        """
+        frame_ops = self.frame_ops or []
+        nodes = {}
+        # ops may share a key_name as long as no op takes it as input
+        shared_keys = set()
+        for op in self.intermediates + frame_ops:
+            if op.key_name in nodes:
+                shared_keys.add(op.key_name)
+            nodes[op.key_name] = op
+        for op in (self.batch_ops or []) + (self.seq_ops or []):
+            if op.inputs is not None:
+                raise ValueError('Only frame ops can have inputs, not {0}'
+                                 .format(op.key_name))
+
+        order = []
+        done = set()
+        visiting = set()
+
+        def visit(op):
+            if id(op) in done:
+                return
+            if id(op) in visiting:
+                raise ValueError('Frame op inputs have a cycle through {0}'
+                                 .format(op.key_name))
+            visiting.add(id(op))
+            for key in op.inputs or []:
+                if key == 'input':
+                    continue
+                if key not in nodes:
+                    raise ValueError('{0} takes unknown input {1}'
+                                     .format(op.key_name, key))
+                if key in shared_keys:
+                    raise ValueError('{0} takes input {1}, which more than '
+                                     'one op has as key_name'
+                                     .format(op.key_name, key))
+                visit(nodes[key])
+            visiting.remove(id(op))
+            done.add(id(op))
+            order.append(op)
+
+        for op in frame_ops:
+            visit(op)
+
+        intermediates = {id(op) for op in self.intermediates}
+        intermediate_keys = {op.key_name for op in self.intermediates}
+        last_use = {}
+        for i, op in enumerate(order):
+            for key in op.inputs or []:
+                if key in intermediate_keys:
+                    last_use[key] = i
+        return [(op, op.inputs or ['input'], id(op) not in intermediates,
+                 [key for key, i_last in last_use.items() if i_last == i])
+                for i, op in enumerate(order)]
 
     def set_seq(self, seq=None):
         """
@@ -171,52 +290,241 @@ class Pipeline:
         ARGS:
             :keep_input_data: boolean check whether we want to keep original
                              data
+
+        RETURNS:
+            FeatureStore holding one column per feature key, indexing it
+            gives Frame records like the old list of frame dicts
+        """
+        self.output = FeatureStore()
+        for frame_dict in self.extract_iter():
+            if self.ring is not None:
+                # ring slots are reused, keep a copy of the input
+                frame_dict['input'] = frame_dict['input'].copy()
+            self.output.append(frame_dict)
+
+        if keep_input_data is False:
+            self.data = []
+
+        return self.output
+
+    def extract_iter(self):
+        """
+        DESCRIPTION:
+            lazily extract all features. Batches are pulled one at a time
+            from self.data (any iterable, e.g. a generator of batches) and
+            each Frame is yielded as soon as its batch, frame and seq
+            features are computed, so memory stays bounded by one batch
+            (2 * n_workers batches with an executor) regardless of the
+            length of the video. Nothing is kept in self.output.
+
+        RETURNS:
+            generator of Frame records (read like frame dicts), in frame
+            order
         """
         if self.batch_ops == self.frame_ops == self.seq_ops == []:
             raise ValueError('No features were specified for extraction.')
-            self.extract_nonseq(self.data, self.batch_ops, self.frame_ops)
 
         self.set_empty_frame(self.batch_ops, self.frame_ops, self.seq_ops)
-        self.output = []
         n_frame = 0
-        n_batch = 0
-
-        for batch in self.data:
-            batch_dict = {}
-            for op in self.batch_ops:
-                batch_dict.update({op.key_name: op.extract(batch)})
-
-            for frame in batch:
-                frame_dict = copy.deepcopy(self.empty_frame)
-                frame_dict['input'] = frame
-                for op in self.frame_ops:
-                    frame_dict['frame_features'][op.key_name] = op.extract(
-                        frame)
-                frame_dict['batch_features'].update(batch_dict)
-                frame_dict['meta_data'].update({'frame_number': n_frame,
-                                               'batch_number': n_batch})
-                self.output.append(frame_dict)
-                n_frame += 1
-            n_batch += 1
-
-        if self.seq_ops != [] and self.seq_ops is not None:
-            for frame in self.output:
-                temp = frame['input']
-                for op in self.seq_ops:
-                    temp = op.extract(temp)
-                    if op.save is True or self.save_all is True:
-                        frame['seq_features'].update({op.key_name: temp})
-            frame['seq_output'] = temp
 
-        if keep_input_data is False:
-            self.data = []
+        results = self.iter_results()
+        try:
+            for n_batch, (batch, frames) in enumerate(results):
+                for frame, frame_dict in zip(batch, frames):
+                    frame_dict['input'] = frame
+                    frame_dict['meta_data'] = {'frame_number': n_frame,
+                                               'batch_number': n_batch}
+                    yield frame_dict
+                    n_frame += 1
+        finally:
+            # gives back the ring slots of batches still in flight
+            results.close()
+
+    def extract_batch(self, batch):
+        """
+        DESCRIPTION:
+            run the batch, frame and seq ops on one batch
 
-        return self.output
+        ARGS:
+            :batch: list or array of frames
+
+        RETURNS:
+            list of Frames without meta data, one per frame
+        """
+        batch_dict = {}
+        for op in self.batch_ops:
+            batch_dict.update({op.key_name: op.extract(batch)})
+
+        seq_features = self.empty_frame['seq_features']
+        frames = []
+        for frame in batch:
+            frame_features = self.extract_frame(frame)
+            frame_dict = Frame(frame, {}, dict(batch_dict), frame_features,
+                               {}, dict(seq_features), {})
+            self.extract_seq(frame_dict)
+            frames.append(frame_dict)
+        return frames
+
+    def extract_frame(self, frame):
+        """
+        DESCRIPTION:
+            run the frame ops on one frame in dependency order, computing
+            each intermediate once and dropping it after its last consumer
+
+        ARGS:
+            :frame: input frame
+
+        RETURNS:
+            dict of frame op key_name -> feature
+        """
+        values = {'input': frame}
+        frame_features = {}
+        for op, inputs, saved, done in self._frame_plan:
+            value = op.extract(*[values[key] for key in inputs])
+            values[op.key_name] = value
+            if saved:
+                frame_features[op.key_name] = value
+            for key in done:
+                del values[key]
+        return frame_features
+
+    def iter_results(self):
+        """
+        DESCRIPTION:
+            run extract_batch on every batch of self.data, on the executor
+            if one is set. At most 2 * n_workers batches are in flight, and
+            results come back in batch order. The process executor copies
+            batches into a FrameRingBuffer the workers read from, batches
+            already in self.ring are read in place.
+
+        RETURNS:
+            generator of (batch, frames)
+        """
+        if self.executor is None:
+            for item in self.data:
+                slot, batch = self._resolve(item)
+                try:
+                    yield batch, self.extract_batch(batch)
+                finally:
+                    self._release(self.ring, slot)
+            return
+
+        window = 2 * self.n_workers
+        if self.ring is not None:
+            # leave the producer a free slot so it never waits on us
+            window = max(1, min(window, self.ring.n_slots - 1))
+
+        if self.executor == 'thread':
+            pool = concurrent.futures.ThreadPoolExecutor(self.n_workers)
+        else:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                self.n_workers, initializer=_init_worker,
+                initargs=(self.batch_ops, self.frame_ops, self.seq_ops,
+                          self.save_all, self.intermediates))
+
+        self._shared = None
+        pending = collections.deque()
+        try:
+            for item in self.data:
+                pending.append(self._submit(pool, item, window))
+                if len(pending) >= window:
+                    yield from self._collect(*pending.popleft())
+            while pending:
+                yield from self._collect(*pending.popleft())
+        finally:
+            for _, future, _, _ in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for _, _, ring, slot in pending:
+                self._release(ring, slot)
+            if self._shared is not None:
+                self._shared.close()
+                self._shared.unlink()
+                self._shared = None
+
+    def _submit(self, pool, item, window):
+        slot, batch = self._resolve(item)
+        if self.executor == 'thread':
+            future = pool.submit(self.extract_batch, batch)
+            return batch, future, self.ring, slot
+
+        if slot is not None:
+            ring = self.ring
+        else:
+            ring = self._shared_ring(batch, window)
+            if ring is None:
+                return batch, pool.submit(_extract_batch, batch), None, None
+            slot = ring.put(batch)
+        future = pool.submit(_extract_slot, _ring_args(ring), slot)
+        return batch, future, ring, slot
+
+    def _shared_ring(self, batch, window):
+        # ring the process executor copies batches into, sized for the
+        # first batch. Batches that don't fit it are pickled instead.
+        if not _is_uniform(batch):
+            return None
+        shape = (len(batch),) + batch[0].shape
+        if self._shared is None:
+            self._shared = FrameRingBuffer(window, shape, batch[0].dtype)
+        if self._shared.slot_shape != shape or \
+                self._shared.dtype != batch[0].dtype:
+            return None
+        return self._shared
+
+    def _resolve(self, item):
+        # items of ring backed data are slot indices
+        if self.ring is None:
+            return None, item
+        return item, self.ring[item]
+
+    def _release(self, ring, slot):
+        if slot is not None:
+            ring.release(slot)
+
+    def _collect(self, batch, future, ring, slot):
+        try:
+            frames = future.result()
+        except Exception:
+            self._release(ring, slot)
+            raise
+        if ring is not self.ring:
+            # the worker is done with its copy of the batch
+            self._release(ring, slot)
+        if self.executor == 'process':
+            frames = pickle.loads(frames)
+
+        try:
+            yield batch, frames
+        finally:
+            # the frames of ring batches are views of the slot, so it is
+            # only given back once the consumer moved on (or stopped)
+            if ring is self.ring:
+                self._release(ring, slot)
+
+    def extract_seq(self, frame_dict):
+        """
+        DESCRIPTION:
+            run the sequential operations on one frame, feeding the output
+            of each op into the next one
+
+        ARGS:
+            :frame_dict: Frame (or frame dict) holding the input frame
+        """
+        if self.seq_ops == [] or self.seq_ops is None:
+            return
+
+        temp = frame_dict['input']
+        for op in self.seq_ops:
+            temp = op.extract(temp)
+            if op.save is True or self.save_all is True:
+                frame_dict['seq_features'].update({op.key_name: temp})
+        frame_dict['seq_output'] = temp
 
     def as_ndarray(self, frame_key=None, batch_key=None, seq_key=None):
         """
         DESCRIPTION:
-            get a feature as a numpy array
+            get a feature as a numpy array. Frame and seq features come
+            straight out of their FeatureStore column without copying.
 
         ARGS:
             :frame_key: key of frame feature to get
@@ -232,6 +540,13 @@ class Pipeline:
         if key_count != 1:
             raise ValueError('One and only one of the three keys may be set.')
 
+        if isinstance(self.output, FeatureStore):
+            if frame_key is not None:
+                return self.output.as_ndarray('frame_features', frame_key)
+            elif batch_key is not None:
+                return self.output.as_ndarray('batch_features', batch_key)
+            return self.output.as_ndarray('seq_features', seq_key)
+
         data = []
         if frame_key is not None:
             for frame_dict in self.output:
@@ -318,3 +633,52 @@ class Pipeline:
         print('seq_ops: {}'.format(self.seq_ops))
         print('empty frame: {}'.format(self.empty_frame))
         print('This method will not print output data.')
+
+
+# pipeline and attached ring buffers of each worker process of the process
+# executor
+_worker_pipeline = None
+_worker_rings = {}
+
+
+def _init_worker(batch_ops, frame_ops, seq_ops, save_all, intermediates):
+    global _worker_pipeline
+    _worker_pipeline = Pipeline(ops=batch_ops + frame_ops, seq=seq_ops,
+                                save_all=save_all,
+                                intermediates=intermediates)
+    _worker_pipeline.set_empty_frame(batch_ops, frame_ops, seq_ops)
+
+
+def _extract_batch(batch):
+    frames = _worker_pipeline.extract_batch(batch)
+    # the main process still has the input frames
+    for frame_dict in frames:
+        frame_dict['input'] = None
+    return pickle.dumps(frames, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _extract_slot(ring_args, slot):
+    # attach to each ring once per worker
+    name = ring_args[-1]
+    if name not in _worker_rings:
+        _worker_rings[name] = FrameRingBuffer(*ring_args)
+    batch = _worker_rings[name][slot]
+    try:
+        # pickled before returning, features may be views of the slot
+        return _extract_batch(batch)
+    finally:
+        del batch
+
+
+def _ring_args(ring):
+    return ring.n_slots, ring.slot_shape, ring.dtype.str, ring.name
+
+
+def _is_uniform(batch):
+    # True if the frames can be stacked without changing their dtype
+    if len(batch) == 0:
+        return False
+    first = batch[0]
+    return all(isinstance(frame, np.ndarray) and
+               frame.shape == first.shape and frame.dtype == first.dtype
+               for frame in batch)
@@ -0,0 +1,157 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import queue
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class FrameRingBuffer:
+    """
+    DESCRIPTION:
+        Fixed number of frame (or batch) slots in one shared memory block.
+        A producer acquires a free slot, writes into ring[slot] and passes
+        the slot index on; consumers in any process read ring[slot] without
+        a copy, and the slot is released once they are done. acquire blocks
+        while every slot is in use, so a producer can't run more than
+        n_slots ahead of its consumers.
+
+        Slots are handed out and released in the process that created the
+        buffer. Other processes attach by name, or by unpickling the
+        buffer, which only sends its name.
+
+    ARGS:
+        :n_slots: number of slots
+        :slot_shape: shape of one slot, e.g. (batch_size, H, W, 3)
+        :dtype: dtype of the frames
+        :name: name of an existing buffer to attach to, None creates one
+    """
+    def __init__(self, n_slots, slot_shape, dtype='uint8', name=None):
+        if n_slots < 1:
+            raise ValueError('Cannot use n_slots < 1')
+
+        self.n_slots = n_slots
+        self.slot_shape = tuple(slot_shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+
+        shape = (n_slots,) + self.slot_shape
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner,
+                                              size=max(1, nbytes))
+        self.name = self.shm.name
+        self.array = np.ndarray(shape, dtype=self.dtype, buffer=self.shm.buf)
+
+        self._free = None
+        if self.owner:
+            self._free = queue.Queue()
+            for slot in range(n_slots):
+                self._free.put(slot)
+
+    def acquire(self, timeout=None):
+        """
+        DESCRIPTION:
+            take a free slot, waiting for one to be released if needed
+
+        ARGS:
+            :timeout: seconds to wait, None waits forever
+
+        RETURNS:
+            slot index
+        """
+        if self._free is None:
+            raise ValueError('Slots are handed out by the process that '
+                             'created the buffer')
+        try:
+            return self._free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('No free slot after {0} sec'.format(timeout))
+
+    def release(self, slot):
+        """
+        DESCRIPTION:
+            give a slot back once its frames are no longer needed
+
+        ARGS:
+            :slot: slot index from acquire
+        """
+        self._free.put(slot)
+
+    def put(self, frames, timeout=None):
+        """
+        DESCRIPTION:
+            acquire a slot and copy frames into it
+
+        ARGS:
+            :frames: array or list of frames matching slot_shape
+            :timeout: seconds to wait for a free slot
+
+        RETURNS:
+            slot index
+        """
+        slot = self.acquire(timeout)
+        try:
+            if len(self.slot_shape) > 0 and isinstance(frames, list):
+                for i, frame in enumerate(frames):
+                    self.array[slot, i] = frame
+            else:
+                self.array[slot] = frames
+        except Exception:
+            self.release(slot)
+            raise
+        return slot
+
+    def n_free(self):
+        """
+        DESCRIPTION:
+            number of slots that can be acquired without waiting
+        """
+        return self._free.qsize() if self._free is not None else 0
+
+    def close(self):
+        """
+        DESCRIPTION:
+            unmap the buffer from this process. Views from ring[slot] must
+            be gone by then.
+        """
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        """
+        DESCRIPTION:
+            free the shared memory once every process closed it
+        """
+        self.shm.unlink()
+
+    def __getitem__(self, slot):
+        return self.array[slot]
+
+    def __len__(self):
+        return self.n_slots
+
+    def __reduce__(self):
+        # other processes attach to the same block by name
+        return (FrameRingBuffer, (self.n_slots, self.slot_shape,
+                                  self.dtype.str, self.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        if self.owner:
+            self.unlink()
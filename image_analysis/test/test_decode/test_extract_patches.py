@@ -0,0 +1,156 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from decode.extract_patches import extract_patches
+from decode.extract_patches import frames_to_patches
+from decode.extract_patches import iter_patches
+from decode.extract_patches import reservoir_sample
+from decode import video_decoder as vd
+
+
+def naive_patches(frames, patch_dims):
+    # reference: loop over every offset like the old extract_patches
+    n, m, o = patch_dims
+    T, N, M = frames.shape
+    patches = []
+    for t in range(T - o + 1):
+        for i in range(N - n + 1):
+            for j in range(M - m + 1):
+                patches.append(frames[t:t + o, i:i + n, j:j + m].flatten())
+    return np.array(patches)
+
+
+class TestExtractPatches(unittest.TestCase):
+
+    def setUp(self):
+        data_dir = 'test/test_data/'
+
+        self.vid_path = data_dir + 'test_video.mp4'
+        self.patch_dims = (3, 2, 2)
+
+        self.timing_start = time.time()
+
+    def tearDown(self):
+        elapsed = time.time() - self.timing_start
+        print('\n{} ({:.5f} sec)'.format(self.id(), elapsed))
+
+    def test_frames_to_patches(self):
+        frames = np.random.randint(0, 256, (5, 7, 6), dtype=np.uint8)
+        for patch_dims in [(1, 1, 1), (3, 2, 2), (7, 6, 5), (2, 3, 4)]:
+            np.testing.assert_array_equal(
+                frames_to_patches(frames, patch_dims),
+                naive_patches(frames, patch_dims))
+
+    def test_iter_patches(self):
+        n_frames = 3
+        frames = vd.decode_mpeg(self.vid_path, batch_size=n_frames,
+                                end_idx=n_frames - 1, gray=True)[0]
+        expected = naive_patches(frames, self.patch_dims)
+
+        # batches smaller than one frame's patches and larger than all
+        for batch_size in [50000, 10**6]:
+            batches = list(iter_patches(self.vid_path, self.patch_dims,
+                                        n_frames=n_frames,
+                                        batch_size=batch_size))
+            self.assertTrue(all(len(batch) <= batch_size
+                                for batch in batches))
+            np.testing.assert_array_equal(np.concatenate(batches), expected)
+
+        with self.assertRaises(ValueError):
+            next(iter_patches(self.vid_path, self.patch_dims, n_frames=1))
+
+    def test_extract_patches(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'patches.bin')
+            store = extract_patches(self.vid_path, self.patch_dims, path,
+                                    n_frames=2, batch_size=40000)
+            self.assertEqual(store[:].shape, (238 * 319, 3 * 2 * 2))
+            self.assertEqual(store.attrs['patch_dims'], [3, 2, 2])
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                             ['patches.bin', 'patches.bin.json'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_sampling(self):
+        n_frames = 3
+        frames = vd.decode_mpeg(self.vid_path, batch_size=n_frames,
+                                end_idx=n_frames - 1, gray=True)[0]
+        every_patch = {patch.tobytes()
+                       for patch in naive_patches(frames, self.patch_dims)}
+
+        for sampling in [{'n_samples': 1000}, {'fraction': .01}]:
+            sample = np.concatenate(list(iter_patches(
+                self.vid_path, self.patch_dims, n_frames=n_frames,
+                batch_size=50000, seed=3, **sampling)))
+            again = np.concatenate(list(iter_patches(
+                self.vid_path, self.patch_dims, n_frames=n_frames,
+                batch_size=50000, seed=3, **sampling)))
+            np.testing.assert_array_equal(sample, again)
+            self.assertTrue(all(patch.tobytes() in every_patch
+                                for patch in sample))
+            if 'n_samples' in sampling:
+                self.assertEqual(len(sample), 1000)
+            else:
+                self.assertAlmostEqual(len(sample) / (2 * 238 * 319), .01,
+                                       delta=.002)
+
+        with self.assertRaises(ValueError):
+            next(iter_patches(self.vid_path, self.patch_dims,
+                              n_samples=10, fraction=.5))
+
+        # numpy and Generator seeds are saved with the store
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'patches.bin')
+            for seed, saved in [(np.int64(3), 3),
+                                (np.random.default_rng(0), None)]:
+                store = extract_patches(self.vid_path, self.patch_dims, path,
+                                        n_frames=n_frames,
+                                        n_samples=np.int64(100), seed=seed)
+                self.assertEqual(len(store), 100)
+                self.assertEqual(store.attrs['seed'], saved)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_reservoir_sample(self):
+        # one pixel patches numbered by frame, in overlapping chunks
+        frames = np.arange(100).reshape(100, 1, 1)
+        chunks = [frames[i:i + 7] for i in range(0, 100, 6)]
+        rng = np.random.default_rng(0)
+
+        counts = np.zeros(100)
+        for _ in range(2000):
+            sample = reservoir_sample(chunks, (1, 1, 2), 10, rng)
+            self.assertEqual(sample.shape, (10, 2))
+            # distinct patches, in video order
+            self.assertTrue(np.all(np.diff(sample[:, 0]) > 0))
+            counts[sample[:, 0]] += 1
+        # each of the 99 patches is kept with probability 10 / 99
+        np.testing.assert_allclose(counts[:99] / 2000, 10 / 99, atol=.04)
+
+        sample = reservoir_sample(chunks, (1, 1, 2), 500, rng)
+        self.assertEqual(len(sample), 99)
+
+
+if __name__ == '__main__':
+    unittest.main()
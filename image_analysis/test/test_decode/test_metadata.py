@@ -0,0 +1,91 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import unittest
+from unittest import mock
+import fractions
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from decode import metadata
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(self):
+        data_dir = 'test/test_data/'
+
+        self.vid_path = data_dir + 'test_video.mp4'
+        self.correct_data = np.load(data_dir + 'test_video_data.npy')
+
+        self.timing_start = time.time()
+
+    def tearDown(self):
+        elapsed = time.time() - self.timing_start
+        print('\n{} ({:.5f} sec)'.format(self.id(), elapsed))
+
+    def test_probe_once(self):
+        cache = metadata.MetadataCache(max_entries=1)
+        with mock.patch.object(metadata, 'probe',
+                               wraps=metadata.probe) as probe:
+            video = cache.get(self.vid_path)
+            self.assertEqual(cache.get(os.path.abspath(self.vid_path)),
+                             video)
+            self.assertEqual(probe.call_count, 1)
+
+        n_frames, height, width = self.correct_data.shape[:3]
+        self.assertEqual((video.height, video.width, video.n_frames),
+                         (height, width, n_frames))
+        self.assertIsInstance(video.fps, fractions.Fraction)
+        self.assertGreater(video.fps, 0)
+        self.assertIsInstance(video.pix_fmt, str)
+
+    def test_sidecar(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            vid_path = shutil.copy(self.vid_path, tmp_dir)
+            video = metadata.MetadataCache(sidecar=True).get(vid_path)
+            self.assertTrue(os.path.exists(vid_path + '.meta.json'))
+
+            # a new cache (e.g. another process) reads the sidecar
+            with mock.patch.object(metadata, 'probe',
+                                   wraps=metadata.probe) as probe:
+                cache = metadata.MetadataCache(sidecar=True)
+                self.assertEqual(cache.get(vid_path), video)
+                self.assertEqual(probe.call_count, 0)
+
+                # a changed video is probed again
+                stat = os.stat(vid_path)
+                os.utime(vid_path, ns=(stat.st_atime_ns,
+                                       stat.st_mtime_ns + 10**9))
+                self.assertEqual(cache.get(vid_path), video)
+                self.assertEqual(probe.call_count, 1)
+
+            # a failed sidecar write leaves nothing next to the video
+            os.remove(vid_path + '.meta.json')
+            with mock.patch.object(metadata.os, 'replace',
+                                   side_effect=OSError):
+                metadata.MetadataCache(sidecar=True).get(vid_path)
+            self.assertEqual(os.listdir(tmp_dir),
+                             [os.path.basename(vid_path)])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
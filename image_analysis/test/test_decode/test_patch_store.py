@@ -0,0 +1,93 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from decode.patch_store import PatchStore
+
+
+class TestPatchStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'patches.bin')
+        self.patches = np.random.randint(0, 256, (1000, 18), dtype=np.uint8)
+
+        self.timing_start = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        elapsed = time.time() - self.timing_start
+        print('\n{} ({:.5f} sec)'.format(self.id(), elapsed))
+
+    def test_append(self):
+        with PatchStore(self.path, batch_size=100) as store:
+            # pieces smaller and larger than batch_size, and single rows
+            store.append(self.patches[:30])
+            self.assertEqual(os.path.getsize(self.path), 0)
+            store.append(self.patches[30:350])
+            self.assertEqual(os.path.getsize(self.path), 300 * 18)
+            for patch in self.patches[350:400]:
+                store.append(patch)
+            store.append(self.patches[400:])
+            self.assertEqual(len(store), 1000)
+
+        store = PatchStore(self.path, mode='r')
+        self.assertEqual(len(store), 1000)
+        self.assertIsInstance(store[:], np.memmap)
+        np.testing.assert_array_equal(store[:], self.patches)
+        np.testing.assert_array_equal(store[123:456],
+                                      self.patches[123:456])
+        with self.assertRaises(ValueError):
+            store.append(self.patches)
+
+    def test_reopen(self):
+        with PatchStore(self.path, batch_size=100,
+                        attrs={'patch_dims': [3, 3, 2]}) as store:
+            store.append(self.patches[:500])
+
+        # rows of an interrupted flush are not in the index
+        with open(self.path, 'ab') as f:
+            f.write(self.patches[500:550].tobytes())
+
+        with PatchStore(self.path, batch_size=100) as store:
+            self.assertEqual(len(store), 500)
+            self.assertEqual(store.attrs['patch_dims'], [3, 3, 2])
+            store.append(self.patches[500:])
+            np.testing.assert_array_equal(store[:], self.patches)
+
+        with self.assertRaises(ValueError):
+            PatchStore(self.path, n_features=9)
+
+        store = PatchStore(self.path, mode='w')
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store[:].shape[0], 0)
+
+    def test_bad_attrs(self):
+        store = PatchStore(self.path, attrs={'seed': object()})
+        store.append(self.patches)
+        with self.assertRaises(TypeError):
+            store.flush()
+        # the temporary index file is removed
+        self.assertEqual(os.listdir(self.tmp_dir), ['patches.bin'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,11 +16,14 @@
 
 import unittest
 import warnings
+import shutil
+import tempfile
 import skvideo.io
 import os
 import time
 import numpy as np
 from decode import video_decoder as vd
+from pipeline.ring_buffer import FrameRingBuffer
 
 """ Do not delete these comments.
 Data for test_video.mp4 is saved in test_video_data.npy.
@@ -264,6 +267,196 @@ class TestVideoDecoder(unittest.TestCase):
                                                 ((end - start + 1) % b_stride -
                                                 numframes)])
 
+    def test_iter_mpeg_batches(self):
+        warnings.simplefilter('ignore')
+
+        start = 3
+        end = 60
+        numframes = 5
+        b_stride = 3
+        batch_list = vd.decode_mpeg(self.vid_path,
+                                    start_idx=start, end_idx=end,
+                                    batch_size=numframes, stride=b_stride)
+
+        for prefetch in [0, 2]:
+            batch_gen = vd.iter_mpeg_batches(self.vid_path,
+                                             start_idx=start, end_idx=end,
+                                             batch_size=numframes,
+                                             stride=b_stride,
+                                             prefetch=prefetch)
+            self.assertFalse(isinstance(batch_gen, list))
+
+            nbatches = 0
+            for batch, expected in zip(batch_gen, batch_list):
+                self.assertTrue(np.array_equal(batch, expected))
+                nbatches += 1
+            self.assertEqual(nbatches, len(batch_list))
+
+        # overlapping batches keep their overlap up to the last frame
+        batch = batch_list[-1]
+        self.assertTrue(np.array_equal(batch[0],
+                                       self.correct_data[57]))
+        self.assertTrue(np.array_equal(batch[3],
+                                       self.correct_data[end]))
+        self.assertTrue(np.array_equal(batch[-1],
+                                       np.zeros(self.correct_data[0].shape)))
+
+        # one frame window with stride > batch_size
+        batch_list = vd.decode_mpeg(self.vid_path, start_idx=14,
+                                    end_idx=14, batch_size=2, stride=5)
+        self.assertEqual(len(batch_list), 1)
+        self.assertTrue(np.array_equal(batch_list[0][0],
+                                       self.correct_data[14]))
+
+        with self.assertRaises(ValueError):
+            vd.iter_mpeg_batches(self.vid_path, prefetch=-1)
+
+    def test_seek(self):
+        warnings.simplefilter('ignore')
+
+        for start, end, size, stride in [(1, 9, 4, 4), (37, 60, 5, 3),
+                                         (99, 100, 2, 1), (0, 5, 3, 3)]:
+            batch_list = vd.decode_mpeg(self.vid_path, start_idx=start,
+                                        end_idx=end, batch_size=size,
+                                        stride=stride, seek=True)
+            expected = vd.decode_mpeg(self.vid_path, start_idx=start,
+                                      end_idx=end, batch_size=size,
+                                      stride=stride)
+            self.assertEqual(len(batch_list), len(expected))
+            for batch, expected_batch in zip(batch_list, expected):
+                self.assertTrue(np.array_equal(batch, expected_batch))
+            self.assertTrue(np.array_equal(batch_list[0][0],
+                                           self.correct_data[start]))
+
+    def test_shards(self):
+        warnings.simplefilter('ignore')
+
+        # shard boundaries inside batches and overlapping windows
+        for start, end, size, stride in [(0, 40, 4, 4), (3, 60, 5, 3),
+                                         (14, 14, 2, 5), (90, 100, 8, 2)]:
+            expected = vd.decode_mpeg(self.vid_path, start_idx=start,
+                                      end_idx=end, batch_size=size,
+                                      stride=stride)
+            batch_list = vd.decode_mpeg(self.vid_path, start_idx=start,
+                                        end_idx=end, batch_size=size,
+                                        stride=stride, n_shards=3,
+                                        shard_size=7)
+            self.assertEqual(len(batch_list), len(expected))
+            for batch, expected_batch in zip(batch_list, expected):
+                self.assertTrue(np.array_equal(batch, expected_batch))
+
+        with self.assertRaises(ValueError):
+            vd.iter_mpeg_batches(self.vid_path, n_shards=0)
+
+    def test_output_params(self):
+        warnings.simplefilter('ignore')
+
+        batch = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=1,
+                               crop=(20, 10, 50, 100))[0]
+        self.assertTrue(np.array_equal(batch,
+                                       self.correct_data[:2, 20:70, 10:110]))
+
+        batch = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=1,
+                               gray=True)[0]
+        self.assertEqual(batch.shape, (2, 240, 320))
+        self.assertEqual(batch.dtype, np.uint8)
+
+        batch = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=1,
+                               gray=True, scale=.5, crop=(0, 0, 100, 200))[0]
+        self.assertEqual(batch.shape, (2, 50, 100))
+        batch = vd.decode_mpeg(self.vid_path, batch_size=2, start_idx=5,
+                               end_idx=6, size=(60, 80), seek=True)[0]
+        self.assertEqual(batch.shape, (2, 60, 80, 3))
+
+        with self.assertRaises(ValueError):
+            vd.decode_mpeg(self.vid_path, end_idx=1, crop=(200, 0, 50, 50))
+        with self.assertRaises(ValueError):
+            vd.decode_mpeg(self.vid_path, end_idx=1, size=(10, 10), scale=.5)
+
+    def test_cache_dir(self):
+        warnings.simplefilter('ignore')
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for start, end, size, stride in [(3, 60, 5, 3), (0, 9, 4, 4),
+                                             (14, 14, 2, 5)]:
+                expected = vd.decode_mpeg(self.vid_path, start_idx=start,
+                                          end_idx=end, batch_size=size,
+                                          stride=stride)
+                for _ in range(2):
+                    batch_list = vd.decode_mpeg(self.vid_path,
+                                                start_idx=start, end_idx=end,
+                                                batch_size=size,
+                                                stride=stride,
+                                                cache_dir=cache_dir)
+                    self.assertEqual(len(batch_list), len(expected))
+                    for batch, expected_batch in zip(batch_list, expected):
+                        self.assertTrue(np.array_equal(batch, expected_batch))
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+            # frames decoded with input seeking get their own entry
+            vd.decode_mpeg(self.vid_path, start_idx=3, end_idx=60,
+                           batch_size=5, stride=3, cache_dir=cache_dir,
+                           seek=True)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+            # full batches are views of the memory mapped cache
+            batch = vd.decode_mpeg(self.vid_path, start_idx=3, end_idx=60,
+                                   batch_size=5, stride=3,
+                                   cache_dir=cache_dir)[0]
+            self.assertIsInstance(batch, np.memmap)
+            self.assertFalse(batch.flags.writeable)
+
+            # an edited video is decoded again
+            video = os.path.join(cache_dir, 'video.mp4')
+            shutil.copy(self.vid_path, video)
+            vd.decode_mpeg(video, end_idx=9, cache_dir=cache_dir)
+            os.utime(video, (0, 0))
+            vd.decode_mpeg(video, end_idx=9, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 7)
+
+    def test_iter_mpeg_batches_ring(self):
+        warnings.simplefilter('ignore')
+
+        batch_list = vd.decode_mpeg(self.vid_path, start_idx=3, end_idx=20,
+                                    batch_size=5, stride=3)
+        shape = (5,) + self.correct_data[0].shape
+        with FrameRingBuffer(2, shape) as ring:
+            slots = vd.iter_mpeg_batches(self.vid_path, start_idx=3,
+                                         end_idx=20, batch_size=5, stride=3,
+                                         ring=ring)
+            nbatches = 0
+            for slot, expected in zip(slots, batch_list):
+                self.assertTrue(np.array_equal(ring[slot], expected))
+                ring.release(slot)
+                nbatches += 1
+            self.assertEqual(nbatches, len(batch_list))
+            self.assertEqual(ring.n_free(), 2)
+
+            with self.assertRaises(ValueError):
+                vd.iter_mpeg_batches(self.vid_path, batch_size=4, ring=ring)
+            with self.assertRaises(ValueError):
+                vd.iter_mpeg_batches(self.vid_path, batch_size=5, ring=ring,
+                                     pad=False)
+
+    def test_iter_mpeg_batches_ring_close(self):
+        warnings.simplefilter('ignore')
+
+        shape = (2,) + self.correct_data[0].shape
+        with FrameRingBuffer(3, shape) as ring:
+            # slots decoded ahead are given back when the consumer stops,
+            # also while the prefetch thread waits for a free slot
+            for prefetch, n_taken in [(2, 1), (1, 1), (1, 2)]:
+                slots = vd.iter_mpeg_batches(self.vid_path, batch_size=2,
+                                             end_idx=19, ring=ring,
+                                             prefetch=prefetch)
+                taken = [next(slots) for _ in range(n_taken)]
+                time.sleep(.5)
+                slots.close()
+                self.assertEqual(ring.n_free(), ring.n_slots - n_taken)
+                for slot in taken:
+                    ring.release(slot)
+                self.assertEqual(ring.n_free(), ring.n_slots)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import unittest
+import time
+import numpy as np
+from .test_features import RGBToGray
+from .test_features import ArgMaxPixel
+from .test_features import BatchOP
+from decode import video_decoder as vd
+from pipeline.pipeline import Pipeline
+from pipeline.feature_store import Column
+from pipeline.feature_store import FeatureStore
+
+
+class TestFeatureStore(unittest.TestCase):
+
+    def setUp(self):
+        data_dir = 'test/test_data/'
+        self.vid_path = data_dir + 'test_video.mp4'
+        self.timing_start = time.time()
+
+    def tearDown(self):
+        elapsed = time.time() - self.timing_start
+        print('\n{} ({:.5f} sec)'.format(self.id(), elapsed))
+
+    def test_column(self):
+        column = Column(capacity=2)
+        frames = np.random.rand(5, 4, 3)
+        for frame in frames:
+            column.append(frame)
+        self.assertEqual(len(column), 5)
+        self.assertTrue(np.array_equal(column.as_ndarray(), frames))
+        self.assertIs(column.as_ndarray().base, column.data)
+        self.assertTrue(np.array_equal(column[-1], frames[-1]))
+
+        # a value of another shape falls back to a list
+        column.append(np.zeros(2))
+        self.assertIsNone(column.data)
+        self.assertEqual(len(column), 6)
+        self.assertTrue(np.array_equal(column[2], frames[2]))
+
+        column = Column()
+        for value in [None, 'a']:
+            column.append(value)
+        self.assertListEqual(list(column.as_ndarray()), [None, 'a'])
+
+    def test_pipeline_output(self):
+        data = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=9,
+                              stride=2)
+
+        rgb2gray = RGBToGray()
+        maxPixel = ArgMaxPixel()
+        batchOp = BatchOP()
+        testpipe = Pipeline(data=data, ops=[rgb2gray, batchOp],
+                            seq=[maxPixel], save_all=True)
+        output = testpipe.extract()
+        self.assertIsInstance(output, FeatureStore)
+
+        frames = list(testpipe.extract_iter())
+        self.assertEqual(len(output), len(frames))
+        for frame, expected in zip(output, frames):
+            self.assertEqual(frame['meta_data'], expected['meta_data'])
+            self.assertEqual(frame['batch_features'],
+                             expected['batch_features'])
+            self.assertEqual(frame['seq_output'], expected['seq_output'])
+            self.assertTrue(np.array_equal(
+                frame['frame_features'][rgb2gray.key_name],
+                expected['frame_features'][rgb2gray.key_name]))
+            # input frames are kept by reference
+            self.assertTrue(np.shares_memory(frame['input'],
+                                             expected['input']))
+
+        gray = testpipe.as_ndarray(frame_key=rgb2gray.key_name)
+        self.assertTrue(np.shares_memory(
+            gray, testpipe.as_ndarray(frame_key=rgb2gray.key_name)))
+        self.assertTrue(np.array_equal(gray, np.array(
+            [f['frame_features'][rgb2gray.key_name] for f in frames])))
+        self.assertTrue(np.array_equal(
+            testpipe.as_ndarray(batch_key=batchOp.key_name),
+            [f['batch_features'][batchOp.key_name] for f in frames]))
+        self.assertTrue(np.array_equal(
+            testpipe.as_ndarray(seq_key=maxPixel.key_name),
+            [f['seq_features'][maxPixel.key_name] for f in frames]))
+
+    def test_batch_numbers(self):
+        # strided batches that start mid video
+        data = vd.decode_mpeg(self.vid_path, batch_size=3, start_idx=4,
+                              end_idx=16, stride=4)
+        batchOp = BatchOP()
+        maxPixel = ArgMaxPixel()
+        testpipe = Pipeline(data=data, ops=[batchOp, maxPixel])
+        output = testpipe.extract()
+        frames = list(testpipe.extract_iter())
+        self.assertEqual([f['batch_features'] for f in output],
+                         [f['batch_features'] for f in frames])
+        self.assertEqual(list(output.as_ndarray('batch_features',
+                                                batchOp.key_name)),
+                         [len(batch) for batch in data for _ in batch])
+
+        # batch numbers need not start at 0 or be contiguous
+        store = FeatureStore()
+        for frame_number, batch_number in enumerate([5, 5, 7, 9, 9]):
+            store.append({'input': None, 'seq_output': None,
+                          'meta_data': {'frame_number': frame_number,
+                                        'batch_number': batch_number},
+                          'batch_features': {'batch': batch_number},
+                          'frame_features': {}, 'seq_features': {}})
+        self.assertEqual([f['batch_features']['batch'] for f in store],
+                         [5, 5, 7, 9, 9])
+        self.assertEqual(list(store.as_ndarray('batch_features', 'batch')),
+                         [5, 5, 7, 9, 9])
+        self.assertIs(store[-1], store[4])
+        with self.assertRaises(IndexError):
+            store[5]
+
+
+if __name__ == '__main__':
+    unittest.main()
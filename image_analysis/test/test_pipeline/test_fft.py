@@ -0,0 +1,153 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import unittest
+import os
+import tempfile
+import time
+import numpy as np
+import pyfftw
+from pipeline.fft import FFT
+from pipeline.fft import load_wisdom
+from pipeline.fft import save_wisdom
+from pipeline.fft import wisdom_paths
+
+
+class TestFFT(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.frame = np.random.rand(48, 65)
+        self.timing_start = time.time()
+
+    def tearDown(self):
+        elapsed = time.time() - self.timing_start
+        print('\n{} ({:.5f} sec)'.format(self.id(), elapsed))
+
+    def test_fft2d(self):
+        fft = FFT(inputshape=self.frame.shape)
+        dft_frame = fft.fft2d(self.frame)
+        self.assertTrue(np.allclose(dft_frame, np.fft.fft2(self.frame)))
+        self.assertTrue(np.allclose(fft.ifft2d(dft_frame).real, self.frame))
+
+    def test_real_fft2d(self):
+        fft = FFT(inputshape=self.frame.shape, real=True)
+        self.assertEqual(fft.spectrumshape, (48, 33))
+
+        dft_frame = fft.fft2d(self.frame)
+        self.assertTrue(np.allclose(dft_frame, np.fft.rfft2(self.frame)))
+        out = fft.ifft2d(dft_frame)
+        self.assertEqual(out.shape, self.frame.shape)
+        self.assertTrue(np.allclose(out, self.frame))
+
+    def test_zero_copy(self):
+        for real in [False, True]:
+            fft = FFT(inputshape=self.frame.shape, real=real)
+            frame = fft.empty_input()
+            frame[:] = self.frame
+            spectrum = fft.empty_spectrum()
+            out = fft.empty_output()
+
+            self.assertIs(fft.fft2d(frame, spectrum), spectrum)
+            expected = np.fft.rfft2(self.frame) if real else \
+                np.fft.fft2(self.frame)
+            self.assertTrue(np.allclose(spectrum, expected))
+            self.assertIs(fft.ifft2d(spectrum, out), out)
+            self.assertTrue(np.allclose(out.real, self.frame))
+
+            # unaligned input is copied into the plan
+            self.assertTrue(np.allclose(fft.fft2d(self.frame[:, ::-1]),
+                                        fft.fft2d(self.frame[:, ::-1].copy())))
+
+    def test_single_precision(self):
+        for real in [False, True]:
+            double = FFT(inputshape=self.frame.shape, real=real)
+            single = FFT(inputshape=self.frame.shape, real=real,
+                         precision='single')
+
+            dft_double = double.fft2d(self.frame).copy()
+            dft_single = single.fft2d(self.frame)
+            self.assertEqual(dft_single.dtype, np.complex64)
+            # float32 has a 24 bit mantissa, ~6e-8 relative rounding per
+            # operation, the transform accumulates a few of those
+            error = np.abs(dft_single - dft_double).max()
+            self.assertLess(error / np.abs(dft_double).max(), 1e-6)
+
+            out = single.ifft2d(dft_single)
+            self.assertEqual(out.real.dtype, np.float32)
+            self.assertLess(np.abs(out.real - self.frame).max(), 1e-6)
+
+        with self.assertRaises(ValueError):
+            FFT(inputshape=self.frame.shape, precision='half')
+
+    def test_batched_fft2d(self):
+        batch = np.random.rand(4, 48, 65)
+        for real in [False, True]:
+            fft = FFT(inputshape=batch.shape, real=real)
+            dft_batch = fft.fft2d(batch)
+            for i, frame in enumerate(batch):
+                expected = np.fft.rfft2(frame) if real else np.fft.fft2(frame)
+                self.assertTrue(np.allclose(dft_batch[i], expected))
+            self.assertTrue(np.allclose(fft.ifft2d(dft_batch).real, batch))
+
+        shifted = FFT.fftshift(batch)
+        self.assertTrue(np.array_equal(shifted[2],
+                                       np.fft.fftshift(batch[2])))
+
+    def test_wisdom(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            wisdom_path = os.path.join(tmpdir, 'fftw.wisdom')
+            self.assertFalse(load_wisdom(wisdom_path))
+
+            # the first worker measures its plans, they are saved at exit
+            # or on save_wisdom
+            fft = FFT(inputshape=self.frame.shape,
+                      planner_effort='FFTW_MEASURE', wisdom_path=wisdom_path)
+            self.assertFalse(os.path.exists(wisdom_path))
+            self.assertIn(wisdom_path, wisdom_paths)
+            wisdom_paths.discard(wisdom_path)
+            save_wisdom(wisdom_path)
+            self.assertTrue(np.allclose(fft.fft2d(self.frame),
+                                        np.fft.fft2(self.frame)))
+
+            # wisdom is text, one line per plan, in no particular order
+            def wisdom_lines():
+                return set(b''.join(pyfftw.export_wisdom()).splitlines())
+            wisdom = wisdom_lines()
+
+            # a new worker starts without wisdom and loads it
+            pyfftw.forget_wisdom()
+            self.assertNotEqual(wisdom_lines(), wisdom)
+            self.assertTrue(load_wisdom(wisdom_path))
+            self.assertEqual(wisdom_lines(), wisdom)
+
+            save_wisdom(wisdom_path)
+            self.assertTrue(load_wisdom(wisdom_path))
+
+            # the file is fftw's own text, not a pickle
+            with open(wisdom_path, 'rb') as f:
+                self.assertTrue(f.read().startswith(b'(fftw'))
+            with open(wisdom_path, 'wb') as f:
+                f.write(b'not wisdom')
+            self.assertFalse(load_wisdom(wisdom_path))
+            self.assertEqual(os.listdir(tmpdir), ['fftw.wisdom'])
+
+        with self.assertRaises(ValueError):
+            FFT(inputshape=self.frame.shape, planner_effort='FFTW_FAST')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,13 +15,20 @@
 
 
 import unittest
+import os
+import tempfile
 import time
+from unittest import mock
 import numpy as np
 import matplotlib.pyplot as plt
 import skimage.io
 import skimage.color
 from decode import video_decoder as vd
+from pipeline import orientation_filter
 from pipeline.orientation_filter import OrientationFilter
+from pipeline.orientation_filter import BatchOrientationFilter
+from pipeline.filter_cache import FilterCache
+from pipeline.filter_cache import filter_cache
 from pyfftw.interfaces.numpy_fft import fftshift
 from pyfftw.interfaces.numpy_fft import fft2
 from pyfftw.interfaces.numpy_fft import ifft2
@@ -62,5 +69,221 @@ class TestFeatureExtractor(unittest.TestCase):
 
             self.assertEqual(np.sum(out), 0)
 
+    def test_triangle(self):
+        # Compare against the per pixel loop the triangle falloff used to be
+        def triangle_loop(theta, center_orientation, center_orientation_2,
+                          orientation_width):
+            ccwb1 = center_orientation - orientation_width / 2
+            cwb1 = center_orientation + orientation_width / 2
+            ccwb2 = center_orientation_2 - orientation_width / 2
+            cwb2 = center_orientation_2 + orientation_width / 2
+            anfilter = np.zeros(theta.shape)
+            for idx, val in np.ndenumerate(theta):
+                if ccwb1 <= val <= cwb1 and val <= center_orientation:
+                    anfilter[idx] = (val - center_orientation +
+                                     orientation_width / 2) * \
+                        2 / orientation_width
+                elif ccwb1 <= val <= cwb1 and val > center_orientation:
+                    anfilter[idx] = (-val + center_orientation +
+                                     orientation_width / 2) * \
+                        2 / orientation_width
+                elif ccwb2 <= val <= cwb2 and val <= center_orientation_2:
+                    anfilter[idx] = (val - center_orientation_2 +
+                                     orientation_width / 2) \
+                        * 2 / orientation_width
+                elif ccwb2 <= val <= cwb2 and val > center_orientation_2:
+                    anfilter[idx] = (-val + center_orientation_2 +
+                                     orientation_width / 2) \
+                        * 2 / orientation_width
+            return anfilter
+
+        filt = OrientationFilter('bowtie', 90, 20, 64, .2, 64, 'triangle')
+        theta = np.concatenate((np.linspace(-90, 360, 4001),
+                                np.arange(-90, 361, 0.5)))
+        for center, width in [(90, 20), (0, 10), (45, 200), (137.5, 20.3)]:
+            center_2 = center + 180
+            bounds = [(center - width / 2, center + width / 2),
+                      (center_2 - width / 2, center_2 + width / 2)]
+            expected = triangle_loop(theta, center, center_2, width)
+            out = filt.triangle(theta, [center, center_2], bounds, width)
+            self.assertTrue(np.array_equal(out, expected))
+
+    def test_filter_cache(self):
+        filt1 = OrientationFilter('bowtie', 45, 20, 64, .2, 64, 'triangle')
+        filt2 = OrientationFilter('bowtie', 45, 20, 64, .2, 64, 'triangle')
+        filt3 = OrientationFilter('bowtie', 50, 20, 64, .2, 64, 'triangle')
+        self.assertTrue(np.shares_memory(filt1.filter, filt2.filter))
+        self.assertFalse(np.shares_memory(filt1.filter, filt3.filter))
+        self.assertFalse(filt1.filter.flags.writeable)
+
+        # a subclass may build its filter differently
+        class FlatFilter(OrientationFilter):
+            def make_filter(self, falloff):
+                return np.ones((self.target_size, self.target_size))
+
+        flat = FlatFilter('bowtie', 45, 20, 64, .2, 64, 'triangle')
+        self.assertTrue(np.all(flat.filter == 1))
+        self.assertFalse(np.shares_memory(filt1.filter, flat.filter))
+
+        filter_cache.clear()
+        filt4 = OrientationFilter('bowtie', 45, 20, 64, .2, 64, 'triangle')
+        self.assertFalse(np.shares_memory(filt1.filter, filt4.filter))
+        self.assertTrue(np.array_equal(filt1.filter, filt4.filter))
+
+        # filters saved by an older filter_version are not served
+        with tempfile.TemporaryDirectory() as cache_dir:
+            filter_cache.configure(cache_dir=cache_dir)
+            try:
+                filter_cache.clear()
+                OrientationFilter('bowtie', 45, 20, 64, .2, 64, 'triangle')
+                with mock.patch.object(orientation_filter, 'filter_version',
+                                       orientation_filter.filter_version + 1):
+                    filter_cache.clear()
+                    OrientationFilter('bowtie', 45, 20, 64, .2, 64,
+                                      'triangle')
+                self.assertEqual(len(os.listdir(cache_dir)), 2)
+            finally:
+                filter_cache.cache_dir = None
+                filter_cache.clear()
+
+        # least recently used arrays are evicted past max_bytes
+        array = np.zeros(100)
+        cache = FilterCache(max_bytes=2 * array.nbytes)
+        cache.put('a', np.zeros(100))
+        cache.put('b', np.ones(100))
+        cache.get('a')
+        cache.put('c', np.ones(100))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.nbytes, 2 * array.nbytes)
+
+        # on disk persistence survives a new cache, e.g. a new process
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = FilterCache(cache_dir=cache_dir)
+            cache.put(('x', 1), np.arange(10))
+            cache = FilterCache(cache_dir=cache_dir)
+            self.assertTrue(np.array_equal(cache.get(('x', 1)),
+                                           np.arange(10)))
+            self.assertIsNone(cache.get(('x', 2)))
+
+            # a failed write leaves no temporary file behind
+            with mock.patch('os.replace', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    cache.put(('x', 3), np.arange(10))
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_inputshape(self):
+        np.random.seed(0)
+        frame1 = np.random.rand(240, 320, 3)
+        frame2 = np.random.rand(100, 120, 3)
+
+        fixed = OrientationFilter('bowtie', 90, 20, 640, .2, 640,
+                                  'triangle', inputshape=(240, 320))
+        self.assertEqual(fixed.filter.shape, (240, 320))
+        expected = fixed.extract(frame1).copy()
+
+        # one filter handles mixed resolutions, one plan per shape
+        lazy = OrientationFilter('bowtie', 90, 20, 640, .2, 640, 'triangle')
+        self.assertEqual(lazy.filter.shape, (640, 640))
+        self.assertTrue(np.allclose(lazy.extract(frame1), expected))
+        self.assertEqual(lazy.extract(frame2).shape, (100, 120))
+        fft = lazy.plan((240, 320))[0]
+        self.assertEqual(lazy.extract(frame1).shape, (240, 320))
+        self.assertIs(lazy.plan((240, 320))[0], fft)
+        self.assertEqual(len(lazy.plans), 2)
+
+        with self.assertRaises(ValueError):
+            lazy.extract(np.random.rand(700, 100, 3))
+
+    def test_real_fft(self):
+        np.random.seed(0)
+        frame = np.random.rand(121, 160, 3)
+        for mask in ['bowtie', 'noise']:
+            real = OrientationFilter(mask, 90, 20, 200, .2, 200, 'triangle',
+                                     real_fft=True)
+            full = OrientationFilter(mask, 90, 20, 200, .2, 200, 'triangle',
+                                     real_fft=False)
+            self.assertEqual(real.plan(frame.shape[:2])[1].shape, (121, 81))
+            self.assertTrue(np.allclose(real.extract(frame),
+                                        full.extract(frame)))
+
+    def test_single_precision(self):
+        # Accuracy of the single precision path against double precision:
+        # for 8 bit video frames the largest error is ~6e-7 of the dynamic
+        # range of the filtered frame (bowtie and noise, real and complex
+        # transforms), far below one gray level (1 / 255 = 4e-3)
+        np.random.seed(0)
+        frame = np.random.randint(0, 256, (120, 160, 3)).astype(np.uint8)
+        for mask in ['bowtie', 'noise']:
+            for real_fft in [True, False]:
+                double = OrientationFilter(mask, 90, 20, 200, .2, 200,
+                                           'triangle', real_fft=real_fft)
+                single = OrientationFilter(mask, 90, 20, 200, .2, 200,
+                                           'triangle', real_fft=real_fft,
+                                           precision='single')
+                expected = double.extract(frame)
+                out = single.extract(frame)
+                self.assertEqual(out.dtype, np.float32)
+                error = np.abs(out - expected).max()
+                self.assertLess(error / np.ptp(expected), 1e-5)
+
+    def test_batch_filter(self):
+        np.random.seed(0)
+        batch = np.random.rand(5, 60, 80, 3)
+        for mask in ['bowtie', 'noise']:
+            filt = OrientationFilter(mask, 90, 20, 100, .2, 100, 'triangle')
+            batch_filt = BatchOrientationFilter(mask, 90, 20, 100, .2, 100,
+                                                'triangle')
+            self.assertTrue(batch_filt.batch_op)
+            self.assertFalse(batch_filt.frame_op)
+
+            out = batch_filt.extract(batch)
+            self.assertEqual(out.shape, (5, 60, 80))
+            for i, frame in enumerate(batch):
+                self.assertTrue(np.allclose(out[i], filt.extract(frame)))
+
+            batch_filt = BatchOrientationFilter(mask, 90, 20, 100, .2, 100,
+                                                'triangle',
+                                                inputshape=(5, 60, 80))
+            self.assertEqual(batch_filt.filter.shape, (60, 80))
+            self.assertTrue(np.allclose(batch_filt.extract(batch), out))
+
+    def test_gray_input(self):
+        np.random.seed(0)
+        frames = np.random.randint(0, 256, (2, 60, 80), dtype=np.uint8)
+        for mask in ['bowtie', 'noise']:
+            filt = OrientationFilter(mask, 90, 20, 100, .2, 100, 'triangle')
+            expected = filt.filter_gray(frames[0] / 255)
+            self.assertTrue(np.allclose(filt.extract(frames[0]), expected))
+
+            batch_filt = BatchOrientationFilter(mask, 90, 20, 100, .2, 100,
+                                                'triangle')
+            out = batch_filt.extract(frames)
+            self.assertEqual(out.shape, (2, 60, 80))
+            self.assertTrue(np.allclose(out[0], expected))
+
+    def test_extract_out(self):
+        np.random.seed(0)
+        frames = np.random.randint(0, 256, (2, 60, 80, 3), dtype=np.uint8)
+        for mask in ['bowtie', 'noise']:
+            filt = OrientationFilter(mask, 90, 20, 100, .2, 100, 'triangle')
+            expected = filt.filter_gray(skimage.color.rgb2gray(frames[0]))
+
+            # frames returned without out do not share the plan buffers
+            first = filt.extract(frames[0])
+            second = filt.extract(frames[1])
+            self.assertTrue(np.allclose(first, expected))
+            self.assertFalse(np.shares_memory(first, second))
+
+            out = np.empty((60, 80))
+            self.assertIs(filt.extract(frames[0], out=out), out)
+            self.assertTrue(np.allclose(out, expected))
+
+            batch_filt = BatchOrientationFilter(mask, 90, 20, 100, .2, 100,
+                                                'triangle')
+            out = np.empty((2, 60, 80))
+            self.assertIs(batch_filt.extract(frames, out=out), out)
+            self.assertTrue(np.allclose(out[0], expected))
+
 if __name__ == '__main__':
     unittest.main()
@@ -16,11 +16,17 @@
 
 import unittest
 import time
+import weakref
+import numpy as np
 from .test_features import RGBToGray
 from .test_features import ArgMaxPixel
+from .test_features import BatchOP
 from decode import video_decoder as vd
+from pipeline.feature import Feature
 from pipeline.pipeline import Pipeline
+from pipeline.frame import Frame
 from pipeline.svm import SVM
+from pipeline.orientation_filter import OrientationFilter
 from sklearn import datasets
 
 
@@ -131,6 +137,172 @@ class TestPipeline(unittest.TestCase):
         self.assertTupleEqual(gray_frames.shape, (n, frame_width,
                                                   frame_height))
 
+    def test_extract_iter(self):
+        data = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=9,
+                              stride=2)
+
+        rgb2gray = RGBToGray()
+        maxPixel = ArgMaxPixel()
+
+        testpipe = Pipeline(data=data,
+                            ops=[maxPixel],
+                            seq=[rgb2gray, maxPixel],
+                            save_all=True)
+        expected = testpipe.extract()
+
+        # batches are pulled lazily from any iterable, e.g. a generator
+        streampipe = Pipeline(data=(batch for batch in data),
+                              ops=[maxPixel],
+                              seq=[rgb2gray, maxPixel],
+                              save_all=True)
+        n = 0
+        for frame, expected_frame in zip(streampipe.extract_iter(),
+                                         expected):
+            self.assertEqual(frame['meta_data'], expected_frame['meta_data'])
+            self.assertEqual(frame['frame_features'][maxPixel.key_name],
+                             expected_frame['frame_features'][
+                                 maxPixel.key_name])
+            self.assertEqual(frame['seq_features'][maxPixel.key_name],
+                             expected_frame['seq_features'][
+                                 maxPixel.key_name])
+            self.assertIsNotNone(frame['seq_output'])
+            n += 1
+
+        self.assertEqual(n, len(expected))
+        self.assertEqual(streampipe.output, [])
+
+    def test_frame_record(self):
+        data = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=3)
+
+        rgb2gray = RGBToGray()
+        maxPixel = ArgMaxPixel()
+        testpipe = Pipeline(data=data, ops=[maxPixel], seq=[rgb2gray])
+        frames = testpipe.extract()
+
+        keys = ['input', 'meta_data', 'batch_features', 'frame_features',
+                'seq', 'seq_features', 'seq_output']
+        for frame in frames:
+            self.assertIsInstance(frame, Frame)
+            self.assertListEqual(list(frame.keys()), keys)
+            self.assertEqual(frame.to_dict().keys(), frame.keys())
+            self.assertIn('frame_features', frame)
+            self.assertEqual(frame['seq_features'], {rgb2gray.key_name: None})
+
+        # features are not shared between frames
+        frames[0]['frame_features']['extra'] = 1
+        self.assertNotIn('extra', frames[1]['frame_features'])
+        self.assertEqual(frames[1]['meta_data'],
+                         {'frame_number': 1, 'batch_number': 0})
+
+        frames[0]['seq_output'] = None
+        self.assertIsNone(frames[0].seq_output)
+        with self.assertRaises(KeyError):
+            frames[0]['other'] = None
+
+    def test_executor(self):
+        # the last batch is padded with float frames
+        data = vd.decode_mpeg(self.vid_path, batch_size=3, end_idx=10)
+
+        rgb2gray = RGBToGray()
+        maxPixel = ArgMaxPixel()
+        filt = OrientationFilter('bowtie', 90, 20, 320, .2, 320, 'triangle',
+                                 nthreads=1)
+        expected = Pipeline(data=data, ops=[filt, maxPixel], seq=[rgb2gray],
+                            save_all=True).extract()
+
+        for executor in ['thread', 'process']:
+            testpipe = Pipeline(data=iter(data), ops=[filt, maxPixel],
+                                seq=[rgb2gray], save_all=True,
+                                executor=executor, n_workers=2)
+            output = testpipe.extract()
+            self.assertEqual(len(output), len(expected))
+            for frame, expected_frame in zip(output, expected):
+                self.assertEqual(frame['meta_data'],
+                                 expected_frame['meta_data'])
+                self.assertTrue(np.shares_memory(frame['input'],
+                                                 expected_frame['input']))
+                self.assertTrue(np.allclose(
+                    frame['frame_features'][filt.key_name],
+                    expected_frame['frame_features'][filt.key_name]))
+                self.assertEqual(frame['frame_features'][maxPixel.key_name],
+                                 expected_frame['frame_features'][
+                                     maxPixel.key_name])
+                self.assertTrue(np.allclose(frame['seq_output'],
+                                            expected_frame['seq_output']))
+
+        with self.assertRaises(ValueError):
+            Pipeline(data=data, ops=[maxPixel], executor='gpu')
+
+    def test_intermediates(self):
+        data = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=3,
+                              stride=2)
+
+        class CountingGray(RGBToGray):
+            calls = 0
+
+            def extract(self, frame):
+                CountingGray.calls += 1
+                # keep a handle to check it is freed after its last use
+                gray = super().extract(frame)
+                self.last = weakref.ref(gray)
+                return gray
+
+        class GrayUnused(Feature):
+            def __init__(self, gray):
+                Feature.__init__(self, 'gray_unused', frame_op=True)
+                self.gray = gray
+
+            def extract(self, frame):
+                return self.gray.last() is None
+
+        gray = CountingGray()
+        args = ('bowtie', 90, 20, 320, .2, 320, 'triangle')
+        bowtie = OrientationFilter(*args, inputs=['grayscale'])
+        noise = OrientationFilter('noise', *args[1:], inputs=['grayscale'])
+        maxPixel = ArgMaxPixel()
+        maxPixel.inputs = ['grayscale']
+        unused = GrayUnused(gray)
+
+        testpipe = Pipeline(data=data, ops=[bowtie, noise, maxPixel, unused],
+                            intermediates=[gray])
+        output = testpipe.extract()
+
+        # computed once per frame, not saved, freed after its last use
+        self.assertEqual(CountingGray.calls, 4)
+        self.assertEqual(len(output[0]['frame_features']), 4)
+        self.assertNotIn(gray.key_name, output[0]['frame_features'])
+        self.assertTrue(output.as_ndarray('frame_features',
+                                          unused.key_name).all())
+
+        filt = OrientationFilter(*args)
+        for frame in output:
+            self.assertTrue(np.allclose(
+                frame['frame_features'][bowtie.key_name],
+                filt.extract(frame['input'])))
+
+        output = Pipeline(data=data, ops=[bowtie, maxPixel],
+                          intermediates=[RGBToGray()], executor='process',
+                          n_workers=2).extract()
+        self.assertTrue(np.allclose(
+            output.as_ndarray('frame_features', maxPixel.key_name),
+            [np.max(RGBToGray().extract(frame)) for batch in data
+             for frame in batch]))
+
+        with self.assertRaises(ValueError):
+            Pipeline(data=data, ops=[bowtie])
+        with self.assertRaises(ValueError):
+            Pipeline(data=data, ops=[bowtie, maxPixel],
+                     intermediates=[gray, RGBToGray()])
+        with self.assertRaises(ValueError):
+            gray.inputs = [bowtie.key_name]
+            Pipeline(data=data, ops=[bowtie], intermediates=[gray])
+
+        # the setters check inputs again
+        batch_op = BatchOP()
+        batch_op.inputs = ['input']
+        with self.assertRaises(ValueError):
+            Pipeline(data=data).set_batch_ops([batch_op])
+
     def test_model_tranining(self):
         # test by running svm on digits
         digits = datasets.load_digits()
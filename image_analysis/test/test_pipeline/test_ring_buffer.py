@@ -0,0 +1,121 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import unittest
+import pickle
+import time
+import warnings
+import numpy as np
+from .test_features import RGBToGray
+from .test_features import ArgMaxPixel
+from decode import video_decoder as vd
+from pipeline.pipeline import Pipeline
+from pipeline.ring_buffer import FrameRingBuffer
+
+
+class TestFrameRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        data_dir = 'test/test_data/'
+        self.vid_path = data_dir + 'test_video.mp4'
+        self.timing_start = time.time()
+
+    def tearDown(self):
+        elapsed = time.time() - self.timing_start
+        print('\n{} ({:.5f} sec)'.format(self.id(), elapsed))
+
+    def test_slots(self):
+        frames = np.arange(24, dtype=np.uint8).reshape(2, 3, 4)
+        with FrameRingBuffer(2, (3, 4)) as ring:
+            first = ring.put(frames[0])
+            second = ring.put(frames[1])
+            self.assertNotEqual(first, second)
+            self.assertEqual(ring.n_free(), 0)
+
+            # back-pressure: no slot until one is released
+            with self.assertRaises(TimeoutError):
+                ring.acquire(timeout=.01)
+            ring.release(first)
+            self.assertEqual(ring.acquire(timeout=.01), first)
+
+            # other processes attach by name, e.g. through pickle
+            attached = pickle.loads(pickle.dumps(ring))
+            self.assertFalse(attached.owner)
+            self.assertTrue(np.array_equal(attached[second], frames[1]))
+            ring[second][0, 0] = 255
+            self.assertEqual(attached[second][0, 0], 255)
+            with self.assertRaises(ValueError):
+                attached.acquire()
+            attached.close()
+
+            # frames that don't fit don't keep the slot
+            ring.release(first)
+            with self.assertRaises(ValueError):
+                ring.put(np.zeros((4, 4)))
+            self.assertEqual(ring.n_free(), 1)
+
+    def test_pipeline(self):
+        warnings.simplefilter('ignore')
+        rgb2gray = RGBToGray()
+        maxPixel = ArgMaxPixel()
+
+        data = vd.decode_mpeg(self.vid_path, batch_size=2, end_idx=9)
+        expected = Pipeline(data=data, ops=[maxPixel],
+                            seq=[rgb2gray]).extract()
+
+        with FrameRingBuffer(3, data[0].shape) as ring:
+            for executor in [None, 'thread', 'process']:
+                slots = vd.iter_mpeg_batches(self.vid_path, batch_size=2,
+                                             end_idx=9, ring=ring,
+                                             prefetch=2)
+                testpipe = Pipeline(data=slots, ops=[maxPixel],
+                                    seq=[rgb2gray], ring=ring,
+                                    executor=executor, n_workers=2)
+                output = testpipe.extract()
+                self.assertEqual(len(output), len(expected))
+                for frame, expected_frame in zip(output, expected):
+                    self.assertEqual(frame['meta_data'],
+                                     expected_frame['meta_data'])
+                    self.assertTrue(np.array_equal(frame['input'],
+                                                   expected_frame['input']))
+                    self.assertEqual(
+                        frame['frame_features'][maxPixel.key_name],
+                        expected_frame['frame_features'][maxPixel.key_name])
+                    self.assertTrue(np.allclose(frame['seq_output'],
+                                                expected_frame['seq_output']))
+                self.assertEqual(ring.n_free(), 3)
+
+    def test_pipeline_early_exit(self):
+        warnings.simplefilter('ignore')
+        maxPixel = ArgMaxPixel()
+
+        shape = (2,) + vd.decode_mpeg(self.vid_path, end_idx=0)[0][0].shape
+        with FrameRingBuffer(3, shape) as ring:
+            for executor in [None, 'thread', 'process']:
+                slots = vd.iter_mpeg_batches(self.vid_path, batch_size=2,
+                                             end_idx=9, ring=ring)
+                testpipe = Pipeline(data=slots, ops=[maxPixel], ring=ring,
+                                    executor=executor, n_workers=2)
+                frames = testpipe.extract_iter()
+                for i, _ in enumerate(frames):
+                    if i == 2:
+                        break
+                frames.close()
+                self.assertEqual(ring.n_free(), ring.n_slots)
+
+
+if __name__ == '__main__':
+    unittest.main()
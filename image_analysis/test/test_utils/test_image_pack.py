@@ -0,0 +1,99 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+import numpy as np
+import skimage.io
+from utils import image_pack
+from utils.image_pack import ImagePack, pack_images
+
+
+class TestImagePack(unittest.TestCase):
+
+    def setUp(self):
+        self.img_dir = 'test/test_data/testimgs/'
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pack_path = os.path.join(self.tmp_dir, 'images.pack')
+        self.timing_start = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        elapsed = time.time() - self.timing_start
+        print('\n{} ({:.5f} sec)'.format(self.id(), elapsed))
+
+    def test_pack_images(self):
+        pack_images(self.img_dir, self.pack_path)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['images.pack', 'images.pack.json'])
+
+        pack = ImagePack(self.pack_path)
+        self.assertEqual(pack.names, ['test1.jpg', 'test2.jpg'])
+        for name in pack.names:
+            self.assertTrue(np.array_equal(
+                pack[name], skimage.io.imread(self.img_dir + name)))
+
+        batches = list(pack.iter_batches(batchsize=2))
+        self.assertEqual(sum(len(batch) for batch in batches), 2)
+        for batch in batches:
+            self.assertFalse(batch.flags.writeable)
+            self.assertTrue(any(np.shares_memory(batch, bucket)
+                                for bucket in pack.buckets))
+
+    def test_mixed_shapes(self):
+        img_dir = os.path.join(self.tmp_dir, 'imgs')
+        os.mkdir(img_dir)
+        shapes = [(8, 9, 3), (8, 9), (10, 9, 3), (8, 9, 3), (8, 9)]
+        images = {}
+        for i, shape in enumerate(shapes):
+            name = '{:02d}.png'.format(i)
+            images[name] = np.random.randint(0, 256, shape, dtype=np.uint8)
+            skimage.io.imsave(os.path.join(img_dir, name), images[name],
+                              check_contrast=False)
+
+        pack = pack_images(img_dir, self.pack_path, n_workers=2)
+        self.assertEqual(len(pack), 5)
+        self.assertEqual(len(pack.buckets), 3)
+        for name, image in images.items():
+            self.assertTrue(np.array_equal(pack[name], image))
+
+        # batches never mix shapes
+        batches = list(pack.iter_batches(batchsize=2))
+        self.assertEqual([batch.shape for batch in batches],
+                         [(2, 8, 9, 3), (2, 8, 9), (1, 10, 9, 3)])
+        self.assertTrue(np.array_equal(batches[0][1], images['03.png']))
+
+    def test_failed_pack(self):
+        # temporary files are removed when the pack or index write fails
+        with mock.patch.object(image_pack.shutil, 'copyfileobj',
+                               side_effect=OSError):
+            with self.assertRaises(OSError):
+                pack_images(self.img_dir, self.pack_path)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+        with mock.patch.object(image_pack.json, 'dump',
+                               side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                pack_images(self.img_dir, self.pack_path)
+        self.assertEqual(os.listdir(self.tmp_dir), ['images.pack'])
+
+
+if __name__ == '__main__':
+    unittest.main()
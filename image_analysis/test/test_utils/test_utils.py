@@ -15,6 +15,9 @@
 
 
 import unittest
+import os
+import shutil
+import tempfile
 import time
 import numpy as np
 import skimage.io
@@ -51,6 +54,45 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(len(imgs[0]), batchsize)
         self.assertEqual(len(imgs[1]), batchsize)
 
+    def test_iter_mult_imgs(self):
+        testimg1 = skimage.io.imread(self.testimg1_path)
+        testimg2 = skimage.io.imread(self.testimg2_path)
+
+        imgs = list(utils.iter_mult_images(dirname=self.img_dir,
+                                           n_workers=2, prefetch=1))
+        self.assertEqual(len(imgs), 2)
+        self.assertTrue(np.array_equal(testimg1, imgs[0][0]))
+        self.assertTrue(np.array_equal(testimg2, imgs[1][0]))
+
+        # the last batch is padded with zero images
+        imgs = list(utils.iter_mult_images(dirname=self.img_dir,
+                                           batchsize=3))
+        self.assertEqual(len(imgs), 1)
+        self.assertEqual(len(imgs[0]), 3)
+        self.assertFalse(imgs[0][2].any())
+        imgs = list(utils.iter_mult_images(dirname=self.img_dir,
+                                           batchsize=3, pad=False))
+        self.assertEqual(len(imgs[0]), 2)
+
+    def test_iter_mult_imgs_order(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            images = [np.random.randint(0, 256, (8 + i, 9, 3),
+                                        dtype=np.uint8) for i in range(20)]
+            for i, image in enumerate(images):
+                skimage.io.imsave(os.path.join(tmp_dir,
+                                               '{:02d}.png'.format(i)),
+                                  image, check_contrast=False)
+
+            batches = list(utils.iter_mult_images(tmp_dir, batchsize=3,
+                                                  n_workers=4, prefetch=5))
+            self.assertEqual(len(batches), 7)
+            for i, image in enumerate(images):
+                self.assertTrue(np.array_equal(batches[i // 3][i % 3],
+                                               image))
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
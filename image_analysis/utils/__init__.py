@@ -1,3 +1,6 @@
 from .fps import FPS
 from .utils import timeit
-from .utils import load_mult_images
\ No newline at end of file
+from .utils import load_mult_images
+from .utils import iter_mult_images
+from .image_pack import pack_images
+from .image_pack import ImagePack
@@ -0,0 +1,152 @@
+# Copyright 2017 Codas Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+
+import collections
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from .utils import iter_mult_images, _image_paths
+
+# bucket offsets in the pack are multiples of this many bytes
+alignment = 64
+
+
+def pack_images(dirname, pack_path, exts=None, n_workers=None):
+    """
+    DESCRIPTION:
+        Decodes every image of a directory once and packs them into one
+        raw file (pack_path) plus a JSON index (pack_path + '.json'), so
+        later runs memory map the pixels instead of decoding the images
+        again. Images are grouped into buckets of equal shape and dtype,
+        each bucket is one contiguous (count x shape) array in the file.
+
+    ARGS:
+        :dirname: directory of the images
+        :pack_path: file to write, replaced if it exists
+        :exts: acceptable file extensions (must be a tuble)
+        :n_workers: number of decoding threads, see iter_mult_images
+
+    RETURNS:
+        ImagePack of the packed images
+    """
+    names = [os.path.basename(path)
+             for path in _image_paths(dirname, exts, 1)]
+    pack_dir = os.path.dirname(os.path.abspath(pack_path))
+
+    # each bucket is written to its own temporary file while decoding
+    buckets = collections.OrderedDict()
+    try:
+        images = iter_mult_images(dirname, exts, n_workers=n_workers,
+                                  pad=False)
+        for name, (image,) in zip(names, images):
+            key = (image.shape, image.dtype.str)
+            if key not in buckets:
+                fd, tmp_path = tempfile.mkstemp(dir=pack_dir)
+                buckets[key] = {'shape': list(image.shape),
+                                'dtype': image.dtype.str, 'files': [],
+                                'file': os.fdopen(fd, 'wb'),
+                                'tmp_path': tmp_path}
+            bucket = buckets[key]
+            bucket['file'].write(np.ascontiguousarray(image).data)
+            bucket['files'].append(name)
+
+        fd, tmp_path = tempfile.mkstemp(dir=pack_dir)
+        try:
+            with os.fdopen(fd, 'wb') as pack:
+                for bucket in buckets.values():
+                    bucket['file'].close()
+                    pack.write(b'\0' * (-pack.tell() % alignment))
+                    bucket['offset'] = pack.tell()
+                    with open(bucket['tmp_path'], 'rb') as f:
+                        shutil.copyfileobj(f, pack)
+            os.replace(tmp_path, pack_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    finally:
+        for bucket in buckets.values():
+            bucket['file'].close()
+            os.remove(bucket['tmp_path'])
+
+    index = {'buckets': [{key: bucket[key] for key in
+                          ('shape', 'dtype', 'offset', 'files')}
+                         for bucket in buckets.values()]}
+    fd, tmp_path = tempfile.mkstemp(dir=pack_dir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, pack_path + '.json')
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return ImagePack(pack_path)
+
+
+class ImagePack:
+    """
+    DESCRIPTION:
+        Read only view of a file written by pack_images. Each bucket of
+        equal shape images is a (count x shape) np.memmap, and batches are
+        slices of it, so serving them copies no pixels.
+
+    ARGS:
+        :pack_path: file written by pack_images
+    """
+    def __init__(self, pack_path):
+        with open(pack_path + '.json') as f:
+            index = json.load(f)
+
+        self.buckets = []
+        self.names = []
+        self._where = {}
+        for i, bucket in enumerate(index['buckets']):
+            files = bucket['files']
+            self.buckets.append(np.memmap(
+                pack_path, dtype=np.dtype(bucket['dtype']), mode='r',
+                offset=bucket['offset'],
+                shape=(len(files),) + tuple(bucket['shape'])))
+            for j, name in enumerate(files):
+                self._where[name] = (i, j)
+            self.names += files
+        self.names.sort()
+
+    def iter_batches(self, batchsize=1):
+        """
+        DESCRIPTION:
+            batches for Pipeline, in sorted filename order within each
+            bucket. A batch never mixes buckets, so the last batch of each
+            bucket may hold fewer than batchsize images.
+
+        ARGS:
+            :batchsize: size of the batches
+
+        RETURNS:
+            generator of (<= batchsize x shape) read only arrays
+        """
+        if batchsize <= 0:
+            raise ValueError('batchsize: {0} is invalid'.format(batchsize))
+        for bucket in self.buckets:
+            for first in range(0, len(bucket), batchsize):
+                yield bucket[first:first + batchsize]
+
+    def __getitem__(self, name):
+        i, j = self._where[name]
+        return self.buckets[i][j]
+
+    def __len__(self):
+        return len(self.names)
@@ -1,3 +1,6 @@
+import collections
+import concurrent.futures
+import itertools
 import time
 import os
 import numpy as np
@@ -36,18 +39,8 @@ def timeit(thresh=None, classname=''):
     return decorator
 
 
-def load_mult_images(dirname, exts=None, batchsize=1):
-    """
-    DESCRIPTION:
-        Load multiple images at once into batches
-
-    ARGS:
-        :dirname: directory of the images
-        :exts: acceptable file extensions (must be a tuble)
-        :batchsize: size of the batches
-
-    """
-
+def _image_paths(dirname, exts, batchsize):
+    # validates the load_mult_images arguments, returns the sorted paths
     if dirname is None or os.path.exists(dirname) is False:
         raise ValueError('dirname: {0} is invalid'.format(dirname))
 
@@ -59,22 +52,90 @@ def load_mult_images(dirname, exts=None, batchsize=1):
     elif not isinstance(exts, tuple):
         raise ValueError('exts: {0} is invalid'.format(exts.__class__))
 
-    batch_list = []
-    batch = []
-    for fname in sorted(os.listdir(dirname)):
-        if fname.endswith(exts):
-            absolute_fname = dirname + fname
-            # load frame add it to batch
-            batch.append(skimage.io.imread(absolute_fname))
+    return [os.path.join(dirname, fname)
+            for fname in sorted(os.listdir(dirname)) if fname.endswith(exts)]
+
+
+def iter_mult_images(dirname, exts=None, batchsize=1, n_workers=None,
+                     prefetch=None, pad=True):
+    """
+    DESCRIPTION:
+        Lazily load multiple images into batches. Images are decoded by a
+        pool of threads (skimage.io.imread releases the GIL while decoding)
+        and batches are yielded in sorted filename order. At most prefetch
+        images are decoded ahead of the batch being built, so a large
+        folder streams into Pipeline without being loaded into memory.
 
-        if len(batch) == batchsize:
-            batch_list.append(batch)
-            batch = []
+    ARGS:
+        :dirname: directory of the images
+        :exts: acceptable file extensions (must be a tuble)
+        :batchsize: size of the batches
+        :n_workers: number of decoding threads, defaults to the number of
+                    cpus
+        :prefetch: number of images decoded ahead, defaults to
+                   2 * n_workers
+        :pad: pad the last batch with zero images to batchsize frames
+
+    RETURNS:
+        generator of batches (lists of images)
+    """
+    paths = iter(_image_paths(dirname, exts, batchsize))
+    n_workers = n_workers or os.cpu_count()
+    prefetch = prefetch or 2 * n_workers
+    if n_workers < 1 or prefetch < 1:
+        raise ValueError('Cannot use n_workers or prefetch < 1')
+
+    pool = concurrent.futures.ThreadPoolExecutor(n_workers)
+    pending = collections.deque(pool.submit(skimage.io.imread, path)
+                                for path in itertools.islice(paths,
+                                                             prefetch))
+    try:
+        batch = []
+        while pending:
+            image = pending.popleft().result()
+            path = next(paths, None)
+            if path is not None:
+                pending.append(pool.submit(skimage.io.imread, path))
+            batch.append(image)
+            if len(batch) == batchsize:
+                yield batch
+                batch = []
+
+        if batch:
+            if pad:
+                batch += [np.zeros_like(batch[0])] * (batchsize - len(batch))
+            yield batch
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def load_mult_images(dirname, exts=None, batchsize=1, n_workers=None):
+    """
+    DESCRIPTION:
+        Load multiple images at once into batches, see iter_mult_images to
+        stream them instead
+
+    ARGS:
+        :dirname: directory of the images
+        :exts: acceptable file extensions (must be a tuble)
+        :batchsize: size of the batches
+        :n_workers: number of decoding threads, defaults to the number of
+                    cpus
+
+    """
+    batch_list = list(iter_mult_images(dirname, exts, batchsize, n_workers,
+                                       pad=False))
+    batch = []
+    if batch_list and len(batch_list[-1]) < batchsize:
+        batch = batch_list.pop()
 
     # padd last batch (if needed) to keep all batches the same size
     if len(batch) < batchsize:
         padsize = batchsize - len(batch)
-        padlist = [np.zeros(shape=batch_list[0][0].shape)] * padsize
+        first = batch_list[0][0] if batch_list else batch[0]
+        padlist = [np.zeros(shape=first.shape)] * padsize
         batch += padlist
         batch_list.append(batch)
 